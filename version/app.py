@@ -68,6 +68,7 @@ class AppWindow(QMainWindow):
     duplicate_check_invoker = pyqtSignal(gallery.GalleryModel)
     admin_db_method_invoker = pyqtSignal(object)
     db_activity_checker = pyqtSignal()
+    hash_indexer_invoker = pyqtSignal()
     graphics_blur = QGraphicsBlurEffect()
 
     def __init__(self, disable_excepthook=False):
@@ -83,6 +84,9 @@ class AppWindow(QMainWindow):
         self._db_startup_thread.start()
         self.db_startup.moveToThread(self._db_startup_thread)
         self.db_startup.DONE.connect(lambda: self.scan_for_new_galleries() if app_constants.LOOK_NEW_GALLERY_STARTUP else None)
+        self.db_startup.DONE.connect(self.start_hash_indexer)
+        self.db_startup.DONE.connect(lambda: threading.Thread(name='Thumbnail Sweeper',
+                                     target=gallerydb.GalleryDB.sweep_thumbs, daemon=True).start())
         self.db_startup_invoker.connect(self.db_startup.startup)
         self.setAcceptDrops(True)
         self.initUI()
@@ -406,12 +410,44 @@ class AppWindow(QMainWindow):
         sort_menu.addAction(s_by_title)
         sort_menu.addAction(s_by_artist)
         self.status_bar.addPermanentWidget(self.stat_info)
+        self.hash_info = QLabel()
+        self.hash_info.setIndent(5)
+        self.hash_info.hide()
+        self.status_bar.addPermanentWidget(self.hash_info)
         #self.status_bar.addAction(self.sort_main)
         self.temp_msg = QLabel()
         self.temp_timer = QTimer()
 
         app_constants.STAT_MSG_METHOD = self.stat_temp_msg
 
+    def start_hash_indexer(self):
+        "Starts hashing pages of galleries lacking hashes in the background"
+        self.hash_indexer = None
+        if not app_constants.HASH_INDEXER:
+            return
+
+        def update_coverage(hashed, total):
+            self.hash_info.setText("Hashed {} of {} ".format(hashed, total))
+            self.hash_info.setToolTip("Galleries with all pages hashed")
+            self.hash_info.setVisible(hashed < total)
+
+        def update_recount(checked, total):
+            self.hash_info.setText("Counting pages {} of {} ".format(checked, total))
+            self.hash_info.setToolTip("Galleries with their page count checked")
+            self.hash_info.setVisible(checked < total)
+
+        thread = QThread(self)
+        thread.finished.connect(thread.deleteLater)
+        self.hash_indexer = gallerydb.HashIndexer()
+        self.hash_indexer.moveToThread(thread)
+        self.hash_indexer.RECOUNT_PROGRESS.connect(update_recount)
+        self.hash_indexer.PROGRESS.connect(update_coverage)
+        self.hash_indexer.DONE.connect(thread.quit)
+        self.hash_indexer.DONE.connect(self.hash_indexer.deleteLater)
+        self.hash_indexer_invoker.connect(self.hash_indexer.start)
+        thread.start()
+        self.hash_indexer_invoker.emit()
+
     def stat_temp_msg(self, msg):
         self.temp_timer.stop()
         self.temp_msg.setText(msg)
@@ -1026,6 +1062,16 @@ class AppWindow(QMainWindow):
         except AttributeError:
             pass
 
+        # hash indexer
+        try:
+            if self.hash_indexer:
+                self.hash_indexer.stop()
+        except (AttributeError, RuntimeError):
+            pass
+
+        # thumbnail worker processes
+        Executors.shutdown()
+
         # settings
         settings.set(self.manga_list_view.current_sort, 'General', 'current sort')
         settings.set(app_constants.IGNORE_PATHS, 'Application', 'ignore paths')
@@ -66,6 +66,7 @@ THUMB_W_SIZE = 133 + SIZE_FACTOR
 
 THUMB_DEFAULT = (THUMB_W_SIZE, THUMB_H_SIZE)
 THUMB_SMALL = (140, 93)
+DEVICE_PIXEL_RATIO = 1 # set on startup, 2x thumbnails are generated and loaded when above 1
 
 # Columns
 COLUMNS = tuple(range(11))
@@ -159,8 +160,24 @@ EXTERNAL_VIEWER_ARGS = get("{$file}", 'Advanced', 'external viewer args', str)
 EXPORT_FORMAT = get(1, 'Advanced', 'export format', int)
 EXPORT_PATH = ''
 
+# DB
+DB_GROUP_COMMIT_MS = get(50, 'Advanced', 'db group commit ms', int) # max time fire-and-forget writes are grouped in one transaction
+DB_GROUP_COMMIT_SIZE = get(200, 'Advanced', 'db group commit size', int) # max amount of writes in one group, 1 disables grouping
+
 # HASH
 HASH_GALLERY_PAGES = get('all', 'Advanced', 'hash gallery pages', int, str)
+HASH_THREADS = get(4, 'Advanced', 'hash threads', int)
+HASH_INDEXER = get(True, 'Advanced', 'background hash indexer', bool)
+HASH_INDEXER_DELAY = get(500, 'Advanced', 'hash indexer delay', int) # ms between galleries
+
+# ARCHIVE
+ARCHIVE_VALIDATION = get('lazy', 'Advanced', 'archive validation', str) # none, lazy or full
+ARCHIVE_POOL_SIZE = get(16, 'Advanced', 'archive pool size', int) # max archives kept open
+
+# THUMBNAIL
+THUMBNAIL_PROCESSES = get(2, 'Advanced', 'thumbnail processes', int) # worker processes for batch thumbnail generation, 0 uses threads
+THUMBNAIL_STORE_BUDGET = get(2048, 'Advanced', 'thumbnail store budget', int) # MiB of thumbnails kept on disk, 0 is unlimited
+THUMBNAIL_ATLAS = get(False, 'Advanced', 'thumbnail atlas', bool) # pack thumbnails into one file, see ThumbnailAtlas
 
 # WEB
 INCLUDE_EH_EXPUNGED = get(False, 'Web', 'include eh expunged', bool)
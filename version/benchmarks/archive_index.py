@@ -0,0 +1,96 @@
+"""
+Time it takes to open a large zip and list every directory in it.
+Builds a zip with many chapter folders and compares ArchiveFile, which indexes members
+by directory when the archive is opened, against scanning the name list on every call,
+like ArchiveFile used to.
+Run from the version directory: python benchmarks/archive_index.py [--chapters N --pages N]
+"""
+
+import argparse, os, sys, tempfile, time, zipfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import utils
+
+
+class NamelistScan:
+    "is_dir, dir_list and dir_contents of a zip by scanning the whole name list"
+
+    def __init__(self, path):
+        self.archive = zipfile.ZipFile(path)
+
+    def namelist(self):
+        return self.archive.namelist()
+
+    def is_dir(self, name):
+        if not name:
+            return False
+        if not name in self.namelist():
+            raise KeyError(name)
+        return name.endswith('/')
+
+    def dir_list(self, only_top_level=False):
+        if only_top_level:
+            return [x for x in self.namelist() if x.endswith('/') and x.count('/') == 1]
+        return [x for x in self.namelist() if x.endswith('/') and x.count('/') >= 1]
+
+    def dir_contents(self, dir_name):
+        if dir_name and not dir_name in self.namelist():
+            raise KeyError(dir_name)
+        if not dir_name:
+            return [x for x in self.namelist() if x.count('/') == 0 or \
+                (x.count('/') == 1 and x.endswith('/'))]
+        dir_con_start = [x for x in self.namelist() if x.startswith(dir_name)]
+        return [x for x in dir_con_start if x.count('/') == dir_name.count('/') or \
+            (x.count('/') == 1 + dir_name.count('/') and x.endswith('/'))]
+
+    def close(self):
+        self.archive.close()
+
+
+def make_archive(path, chapters, pages):
+    "Writes a zip with chapter folders of pages and a subfolder in each chapter"
+    with zipfile.ZipFile(path, 'w') as z:
+        z.writestr('cover.jpg', b'x')
+        for c in range(chapters):
+            z.writestr('c{:04}/'.format(c), b'')
+            z.writestr('c{:04}/extra/'.format(c), b'')
+            z.writestr('c{:04}/extra/credits.jpg'.format(c), b'x')
+            for p in range(pages):
+                z.writestr('c{:04}/{:04}.jpg'.format(c, p), b'x')
+
+
+def list_all(archive):
+    "What check_archive does: looks into every directory. Returns the listings"
+    listing = {'': archive.dir_contents('')}
+    for d in archive.dir_list():
+        listing[d] = (archive.is_dir(d), archive.dir_contents(d))
+    return listing, archive.dir_list(True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--chapters', type=int, default=100)
+    parser.add_argument('--pages', type=int, default=100, help='pages per chapter')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'large.zip')
+        make_archive(path, args.chapters, args.pages)
+        results = {}
+        for name, opener in (('name list scan', NamelistScan),
+                             ('indexed', lambda p: utils.ArchiveFile(p, utils.ArchiveFile.NO_VALIDATION))):
+            utils.ArchivePool.clear()
+            start = time.perf_counter()
+            archive = opener(path)
+            opened = time.perf_counter()
+            results[name] = list_all(archive)
+            listed = time.perf_counter()
+            print('{:<16} {} members  open {:7.4f}s  list {:7.4f}s'.format(
+                name, len(archive.namelist()), opened - start, listed - opened))
+            archive.close()
+        assert results['name list scan'] == results['indexed'], 'listings differ'
+
+
+if __name__ == '__main__':
+    main()
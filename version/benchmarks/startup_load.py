@@ -0,0 +1,99 @@
+"""
+Time it takes to load chapters, tags and hashes of every gallery on startup.
+Fills a temporary DB and compares the bulk loaders DatabaseStartup uses against
+loading each gallery with its own method queue round trip, like startup used to.
+Run from the version directory: python benchmarks/startup_load.py [--galleries N]
+"""
+
+import argparse, os, sys, tempfile, time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from database import db
+from database.db import DBBase
+from gallerydb import execute, ChapterDB, TagDB, HashDB
+
+
+def fill(galleries, chapters, tags, hashes):
+    "Inserts galleries with the given number of chapters, tags and page hashes each"
+    namespaces = ['artist', 'character', 'female', 'male', 'parody', 'group', 'language', None]
+    with DBBase.transaction():
+        DBBase.executemany(DBBase, 'INSERT INTO series(series_id, title) VALUES(?, ?)',
+            [(g, 'gallery {}'.format(g)) for g in range(1, galleries+1)])
+        DBBase.executemany(DBBase, 'INSERT INTO chapters VALUES(NULL, ?, ?, ?, ?, ?, ?)',
+            [(g, '', c, str.encode('/galleries/{}/{}'.format(g, c)), 20, 0)
+                for g in range(1, galleries+1) for c in range(chapters)])
+        DBBase.executemany(DBBase, 'INSERT INTO namespaces(namespace_id, namespace) VALUES(?, ?)',
+            [(n, ns or 'default') for n, ns in enumerate(namespaces, 1)])
+        DBBase.executemany(DBBase, 'INSERT INTO tags(tag_id, tag) VALUES(?, ?)',
+            [(t, 'tag {}'.format(t)) for t in range(1, 2001)])
+        DBBase.executemany(DBBase, 'INSERT INTO tags_mappings VALUES(?, ?, ?)',
+            [(t, t % len(namespaces) + 1, t) for t in range(1, 2001)])
+        DBBase.executemany(DBBase, 'INSERT INTO series_tags_map VALUES(?, ?)',
+            [(g, (g * 7 + t * 131) % 2000 + 1) for g in range(1, galleries+1) for t in range(tags)])
+        DBBase.executemany(DBBase, 'INSERT INTO hashes(hash, series_id, chapter_id, page) VALUES(?, ?, ?, ?)',
+            [(str.encode('{:032x}'.format(g * 1000 + p)), g, None, p)
+                for g in range(1, galleries+1) for p in range(hashes)])
+
+
+def gallery_tags(series_id):
+    "The per-gallery tag loader startup used to call, with 3 queries per tag mapping"
+    tags = {}
+    for m in DBBase.execute(DBBase, 'SELECT tags_mappings_id FROM series_tags_map WHERE series_id=?',
+            (series_id,)).fetchall():
+        for row in DBBase.execute(DBBase, 'SELECT namespace_id, tag_id FROM tags_mappings WHERE tags_mappings_id=?',
+                (m['tags_mappings_id'],)).fetchall():
+            ns = DBBase.execute(DBBase, 'SELECT namespace FROM namespaces WHERE namespace_id=?',
+                (row['namespace_id'],)).fetchone()['namespace']
+            tag = DBBase.execute(DBBase, 'SELECT tag FROM tags WHERE tag_id=?',
+                (row['tag_id'],)).fetchone()['tag']
+            tags.setdefault(ns, []).append(tag)
+    return tags
+
+
+def per_gallery(ids):
+    chapters = {g:execute(ChapterDB.get_chapters_for_gallery, False, g) for g in ids}
+    tags = {g:execute(gallery_tags, False, g) for g in ids}
+    hashes = {g:execute(HashDB.get_gallery_hashes, False, g) for g in ids}
+    return chapters, tags, hashes
+
+
+def bulk(ids):
+    return (execute(ChapterDB.get_all_chapters, False),
+            execute(TagDB.get_all_gallery_tags, False),
+            execute(HashDB.get_all_gallery_hashes, False))
+
+
+def summary(loaded):
+    "Makes the results of both loaders comparable"
+    chapters, tags, hashes = loaded
+    return ({g:sorted((c.number, c.path, c.pages) for c in chaps) for g, chaps in chapters.items() if len(chaps)},
+            {g:{ns:sorted(t) for ns, t in nstags.items()} for g, nstags in tags.items() if nstags},
+            {g:sorted(h) for g, h in hashes.items() if h})
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--galleries', type=int, default=5000)
+    parser.add_argument('--chapters', type=int, default=2, help='chapters per gallery')
+    parser.add_argument('--tags', type=int, default=15, help='tags per gallery')
+    parser.add_argument('--hashes', type=int, default=20, help='page hashes per gallery')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        DBBase._DB_CONN = db.init_db(os.path.join(tmp, 'startup.db'))
+        fill(args.galleries, args.chapters, args.tags, args.hashes)
+        ids = list(range(1, args.galleries+1))
+        results = {}
+        for name, loader in (('per gallery', per_gallery), ('bulk', bulk)):
+            start = time.perf_counter()
+            loaded = loader(ids)
+            print('{:<12} {:8.2f}s'.format(name, time.perf_counter() - start))
+            results[name] = summary(loaded)
+        assert results['per gallery'] == results['bulk'], 'loaders returned different data'
+        DBBase.close()
+        DBBase._DB_CONN = None
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,65 @@
+"""
+Thumbnails per second of the batch thumbnail task on the thread pool and on worker processes.
+Generates covers in cbz files and runs executors._task_thumbnail_process on each backend.
+Run from the version directory: python benchmarks/thumbnails.py [--covers N]
+"""
+
+import argparse, io, multiprocessing, os, sys, tempfile, time, zipfile
+from concurrent import futures
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from PIL import Image
+
+import executors
+
+
+def make_covers(directory, count, size=(2500, 3500)):
+    "Writes count cbz files with one noisy JPEG cover each. Returns their PageSource arguments"
+    cover = Image.effect_noise(size, 60).convert('RGB')
+    buf = io.BytesIO()
+    cover.save(buf, 'JPEG', quality=90)
+    args = []
+    for n in range(count):
+        path = os.path.join(directory, '{}.cbz'.format(n))
+        with zipfile.ZipFile(path, 'w') as z:
+            z.writestr('001.jpg', buf.getvalue())
+        args.append((None, path))
+    return args
+
+
+def run(executor, args, thumb_dir):
+    "Returns thumbnails per second"
+    start = time.perf_counter()
+    fs = [executor.submit(executors._task_thumbnail_process, a, None, 133, 190, thumb_dir) for a in args]
+    for f in fs:
+        assert f.result().startswith(thumb_dir)
+    return len(args) / (time.perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--covers', type=int, default=48)
+    parser.add_argument('--threads', type=int, default=3)
+    parser.add_argument('--processes', type=int, nargs='*', default=[2, 4])
+    options = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        args = make_covers(directory, options.covers)
+        results = []
+        with futures.ThreadPoolExecutor(options.threads) as ex:
+            thumb_dir = tempfile.mkdtemp(dir=directory)
+            results.append(('threads({})'.format(options.threads), run(ex, args, thumb_dir)))
+        for n in options.processes:
+            with futures.ProcessPoolExecutor(n, mp_context=multiprocessing.get_context('spawn')) as ex:
+                ex.submit(int).result() # start the workers before timing
+                thumb_dir = tempfile.mkdtemp(dir=directory)
+                results.append(('processes({})'.format(n), run(ex, args, thumb_dir)))
+
+    print('{} covers, {} CPUs'.format(options.covers, os.cpu_count()))
+    for label, rate in results:
+        print('{:<16} {:.1f} thumbs/s'.format(label, rate))
+
+
+if __name__ == '__main__':
+    main()
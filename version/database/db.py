@@ -13,7 +13,7 @@
 #"""
 
 import os, sqlite3, threading, queue
-import logging, time, shutil
+import logging, time, shutil, contextlib
 
 from . import db_constants
 log = logging.getLogger(__name__)
@@ -233,8 +233,46 @@ def series_list_map_sql(cols=False):
         return sql, col_list
     return sql
 
+def archive_manifests_sql(cols=False):
+    sql ="""
+        CREATE TABLE IF NOT EXISTS archive_manifests(
+                    path TEXT PRIMARY KEY,
+                    size INTEGER,
+                    mtime REAL,
+                    members TEXT,
+                    galleries TEXT);
+        """
+    col_list = [
+        'path TEXT PRIMARY KEY',
+        'size INTEGER',
+        'mtime REAL',
+        'members TEXT',
+        'galleries TEXT',
+        ]
+    if cols:
+        return sql, col_list
+    return sql
+
+def indexes_sql():
+    """
+    Indexes for lookups not covered by the implicit UNIQUE indexes.
+    tags.tag, namespaces.namespace, hashes.hash and series_tags_map.series_id
+    are already served by their UNIQUE constraints.
+    tests/test_indexes.py checks that the lookups use them.
+    """
+    sql = """
+        CREATE INDEX IF NOT EXISTS idx_series_path ON series(series_path);
+        CREATE INDEX IF NOT EXISTS idx_chapters_series ON chapters(series_id, chapter_number);
+        CREATE INDEX IF NOT EXISTS idx_tags_mappings_tag ON tags_mappings(tag_id, namespace_id);
+        CREATE INDEX IF NOT EXISTS idx_hashes_series ON hashes(series_id, chapter_id, page, hash);
+        CREATE INDEX IF NOT EXISTS idx_hashes_chapter ON hashes(chapter_id, page);
+        CREATE INDEX IF NOT EXISTS idx_series_list_map_series ON series_list_map(series_id, list_id);
+        """
+    return sql
+
 STRUCTURE_SCRIPT = series_sql()+chapters_sql()+namespaces_sql()+tags_sql()+tags_mappings_sql()+\
-    series_tags_mappings_sql()+hashes_sql()+list_sql()+series_list_map_sql()
+    series_tags_mappings_sql()+hashes_sql()+list_sql()+series_list_map_sql()+archive_manifests_sql()+\
+    indexes_sql()
 
 def global_db_convert(conn):
     """
@@ -252,6 +290,7 @@ def global_db_convert(conn):
     hashes, hashes_cols = hashes_sql(True)
     _list, list_cols = list_sql(True)
     series_list_map, series_list_map_cols = series_list_map_sql(True)
+    archive_manifests, archive_manifests_cols = archive_manifests_sql(True)
     
     t_d = {}
     t_d['series'] = series_cols
@@ -263,6 +302,7 @@ def global_db_convert(conn):
     t_d['hashes'] = hashes_cols
     t_d['list'] = list_cols
     t_d['series_list_map'] = series_list_map_cols
+    t_d['archive_manifests'] = archive_manifests_cols
 
     log_d('Checking table structures')
     c.executescript(STRUCTURE_SCRIPT)
@@ -280,6 +320,50 @@ def global_db_convert(conn):
     log_d('Commited DB changes')
     return c
 
+def convert_hashes(conn, batch_size=5000):
+    """
+    Converts hashes stored as hex-digits to raw 20-byte digests.
+    Rows are converted in batches, committing after each batch.
+    Don't use this method directly. Use the add_db_revisions instead.
+    """
+    log_i('Converting hashes to binary')
+    c = conn.cursor()
+    converted = 0
+    while True:
+        c.execute("SELECT hash_id, hash FROM hashes WHERE typeof(hash)='text' LIMIT ?", (batch_size,))
+        rows = c.fetchall()
+        if not rows:
+            break
+        executing = []
+        invalid = []
+        for r in rows:
+            try:
+                executing.append((bytes.fromhex(r['hash']), r['hash_id']))
+            except ValueError:
+                invalid.append((r['hash_id'],))
+        c.executemany('UPDATE OR REPLACE hashes SET hash=? WHERE hash_id=?', executing)
+        # will be regenerated when needed
+        c.executemany('DELETE FROM hashes WHERE hash_id=?', invalid)
+        conn.commit()
+        converted += len(rows)
+        log_d('Converted {} hashes'.format(converted))
+    return c
+
+def clear_archive_hashes(conn):
+    """
+    Removes hashes of pages in archives. Archive pages used to be numbered
+    including directories and non-image members, the hash indexer regenerates them.
+    Don't use this method directly. Use the add_db_revisions instead.
+    """
+    log_i('Removing hashes of archive pages')
+    c = conn.cursor()
+    c.execute("""DELETE FROM hashes WHERE series_id IN (SELECT series_id FROM series WHERE is_archive=1)
+                OR chapter_id IN (SELECT chapter_id FROM chapters WHERE in_archive=1
+                OR lower(chapter_path) LIKE '%.zip' OR lower(chapter_path) LIKE '%.cbz'
+                OR lower(chapter_path) LIKE '%.rar' OR lower(chapter_path) LIKE '%.cbr')""")
+    conn.commit()
+    return c
+
 def add_db_revisions(old_db):
     """
     Adds specific DB revisions items.
@@ -291,6 +375,14 @@ def add_db_revisions(old_db):
 
     log_i('Converting tables and columns')
     c = global_db_convert(conn)
+    convert_hashes(conn)
+    if db_constants.REAL_DB_VERSION < 0.30:
+        clear_archive_hashes(conn)
+
+    log_d('Analyzing indexes')
+    c.execute('ANALYZE')
+    conn.commit()
+    c.execute('VACUUM')
 
     log_d('Updating DB version')
     c.execute('UPDATE version SET version=? WHERE 1', (db_constants.CURRENT_DB_VERSION,))
@@ -360,64 +452,283 @@ def init_db(path=db_constants.DB_PATH):
 
     conn.isolation_level = None
     conn.execute("PRAGMA foreign_keys = on")
+    # lets the read connections run alongside the writer
+    conn.execute("PRAGMA journal_mode = WAL")
     return conn
 
+class ResultCursor:
+    """
+    Holds the rows of a query run on a pooled read connection.
+    Can be used like a read-only cursor.
+    """
+    lastrowid = None
+
+    def __init__(self, rows):
+        self._rows = rows
+        self._pos = 0
+
+    def fetchone(self):
+        try:
+            row = self._rows[self._pos]
+        except IndexError:
+            return None
+        self._pos += 1
+        return row
+
+    def fetchall(self):
+        rows = self._rows[self._pos:]
+        self._pos = len(self._rows)
+        return rows
+
+    def __iter__(self):
+        return iter(self.fetchall())
+
+class ReadConnectionPool:
+    """
+    A bounded pool of read-only connections to the DB file of a writer connection.
+    Connections are opened on demand, a caller blocks while all of them are in use.
+    """
+    def __init__(self, writer, path, size=db_constants.READ_POOL_SIZE):
+        self.writer = writer
+        self.path = path
+        self._conns = queue.LifoQueue()
+        for x in range(size):
+            self._conns.put(None)
+        self._all = []
+        self._closed = False
+
+    @classmethod
+    def for_connection(cls, conn):
+        "Returns a pool for the given writer connection, or None if it can't have one"
+        if not conn:
+            return None
+        try:
+            path = conn.execute('PRAGMA database_list').fetchone()[2]
+            journal_mode = conn.execute('PRAGMA journal_mode').fetchone()[0]
+        except sqlite3.Error:
+            return None
+        # readers would block on the writer without WAL, and memory DBs can't be shared
+        if not path or journal_mode.lower() != 'wal':
+            return None
+        return cls(conn, path)
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, check_same_thread=False)
+        conn.row_factory = sqlite3.Row
+        conn.isolation_level = None
+        conn.execute("PRAGMA query_only = on")
+        self._all.append(conn)
+        return conn
+
+    def execute(self, *args):
+        "Runs a query on a free connection. Returns a ResultCursor"
+        if self._closed:
+            raise db_constants.NoDatabaseConnection
+        conn = self._conns.get()
+        try:
+            if conn is None:
+                conn = self._connect()
+            return ResultCursor(conn.execute(*args).fetchall())
+        finally:
+            self._conns.put(conn)
+
+    def close(self):
+        self._closed = True
+        for conn in self._all:
+            try:
+                conn.close()
+            except sqlite3.Error:
+                pass
+        self._all.clear()
+
 class DBBase:
-    "The base DB class. _DB_CONN should be set at runtime on startup"
+    """
+    The base DB class. _DB_CONN should be set at runtime on startup.
+    _DB_CONN is the only connection writing to the DB. SELECTs go to a pool of read
+    connections when the DB is in WAL mode, unless they come from the thread which
+    holds the open transaction. Other threads wait for that transaction to end before
+    they write, so they never write into it and can read back what they wrote.
+    """
     _DB_CONN = None
+    _READ_POOL = None
     _AUTO_COMMIT = True
-    _STATE = {'active':False}
+    # owner: ident of the thread in the transaction, savepoints: its savepoint nesting depth
+    _STATE = {'active':False, 'group':False, 'owner':None, 'savepoints':0}
+    _ROLLBACK_HOOKS = []
+    _pool_lock = threading.Lock()
+    # held by the owner of the open transaction and around every statement on the writer
+    _write_lock = threading.RLock()
 
     def __init__(self, **kwargs):
         pass
 
     @classmethod
     def begin(cls):
-        "Useful when modifying for a large amount of data"
-        if not cls._STATE['active']:
-            cls._AUTO_COMMIT = False
-            cls.execute(cls, "BEGIN TRANSACTION")
+        """
+        Useful when modifying for a large amount of data.
+        Waits while another thread's transaction is active.
+        """
+        DBBase._write_lock.acquire()
+        if cls._STATE['active']:
+            # already ours, the lock is held until it ends
+            DBBase._write_lock.release()
+        else:
+            DBBase._AUTO_COMMIT = False
+            try:
+                cls.execute(cls, "BEGIN TRANSACTION")
+            except:
+                DBBase._AUTO_COMMIT = True
+                DBBase._write_lock.release()
+                raise
             cls._STATE['active'] = True
+            cls._STATE['owner'] = threading.get_ident()
+        # an explicit transaction takes over an open group commit
+        cls._STATE['group'] = False
         #print("STARTED DB OPTIMIZE")
 
     @classmethod
     def end(cls):
-        "Called to commit and end transaction"
+        "Called to commit and end transaction. Waits while another thread's transaction is active"
+        with DBBase._write_lock:
+            if cls._STATE['active']:
+                try:
+                    cls.execute(cls, "COMMIT")
+                except sqlite3.OperationalError:
+                    pass
+                DBBase._AUTO_COMMIT = True
+                cls._STATE['active'] = False
+                cls._STATE['owner'] = None
+                DBBase._write_lock.release()
+            cls._STATE['group'] = False
+        #print("ENDED DB OPTIMIZE")
+
+    @classmethod
+    def rollback(cls):
+        "Called to discard and end transaction. Waits while another thread's transaction is active"
+        with DBBase._write_lock:
+            if cls._STATE['active']:
+                try:
+                    cls.execute(cls, "ROLLBACK")
+                except sqlite3.OperationalError:
+                    pass
+                DBBase._AUTO_COMMIT = True
+                cls._STATE['active'] = False
+                cls._STATE['owner'] = None
+                DBBase._write_lock.release()
+                DBBase._rolled_back()
+            cls._STATE['group'] = False
+
+    @classmethod
+    def on_rollback(cls, callback):
+        "Registers a callback to be called after a transaction or savepoint was rolled back"
+        DBBase._ROLLBACK_HOOKS.append(callback)
+
+    @staticmethod
+    def _rolled_back():
+        "Lets caches built from rows written in the discarded transaction drop them"
+        for callback in DBBase._ROLLBACK_HOOKS:
+            callback()
+
+    @classmethod
+    def begin_group(cls):
+        """
+        Starts a group commit: a transaction shared by several queued writes.
+        Returns False if another transaction is already active.
+        """
         if cls._STATE['active']:
+            return False
+        cls.begin()
+        cls._STATE['group'] = True
+        return True
+
+    @classmethod
+    def end_group(cls):
+        "Commits the group commit unless an explicit transaction has taken it over"
+        if cls._STATE['group']:
+            cls.end()
+
+    @classmethod
+    @contextlib.contextmanager
+    def transaction(cls):
+        """
+        Runs the statements in the with-block in one transaction.
+        Inside the current thread's active transaction a savepoint is used instead,
+        other threads wait for that transaction to end and then start their own.
+        """
+        if DBBase._owns_transaction():
+            # only the owner touches the depth, under the write lock
+            DBBase._STATE['savepoints'] += 1
+            name = 'nested_{}'.format(DBBase._STATE['savepoints'])
             try:
-                cls.execute(cls, "COMMIT")
-            except sqlite3.OperationalError:
-                pass
-            cls._AUTO_COMMIT = True
-            cls._STATE['active'] = False
-        #print("ENDED DB OPTIMIZE")
+                cls.execute(cls, "SAVEPOINT {}".format(name))
+                try:
+                    yield
+                except:
+                    cls.execute(cls, "ROLLBACK TO {}".format(name))
+                    cls.execute(cls, "RELEASE {}".format(name))
+                    DBBase._rolled_back()
+                    raise
+                cls.execute(cls, "RELEASE {}".format(name))
+            finally:
+                DBBase._STATE['savepoints'] -= 1
+            return
+        cls.begin()
+        try:
+            yield
+        except:
+            cls.rollback()
+            raise
+        cls.end()
+
+    @classmethod
+    def _read_pool(cls):
+        "Returns the read pool for the current writer connection, or None"
+        with DBBase._pool_lock:
+            pool = DBBase._READ_POOL
+            if pool and pool.writer is DBBase._DB_CONN:
+                return pool
+            if pool:
+                pool.close()
+            DBBase._READ_POOL = ReadConnectionPool.for_connection(DBBase._DB_CONN)
+            return DBBase._READ_POOL
+
+    @staticmethod
+    def _owns_transaction():
+        return DBBase._STATE['active'] and DBBase._STATE['owner'] == threading.get_ident()
 
     def execute(self, *args):
         "Same as cursor.execute"
         if not self._DB_CONN:
             raise db_constants.NoDatabaseConnection
         log_d('DB Query: {}'.format(args).encode(errors='ignore'))
-        if self._AUTO_COMMIT:
-            try:
-                with self._DB_CONN:
-                    return self._DB_CONN.execute(*args)
-            except sqlite3.InterfaceError:
-                    return self._DB_CONN.execute(*args)
-
-        else:
-            return self._DB_CONN.execute(*args)
+        # other threads mustn't see the uncommitted data of an open transaction or share its cursor
+        if not DBBase._owns_transaction() and args[0].lstrip()[:6].upper() == 'SELECT':
+            pool = DBBase._read_pool()
+            if pool:
+                return pool.execute(*args)
+        with DBBase._write_lock:
+            if self._AUTO_COMMIT:
+                try:
+                    with self._DB_CONN:
+                        return self._DB_CONN.execute(*args)
+                except sqlite3.InterfaceError:
+                        return self._DB_CONN.execute(*args)
+
+            else:
+                return self._DB_CONN.execute(*args)
     
     def executemany(self, *args):
         "Same as cursor.executemany"
         if not self._DB_CONN:
             raise db_constants.NoDatabaseConnection
         log_d('DB Query: {}'.format(args).encode(errors='ignore'))
-        if self._AUTO_COMMIT:
-            with self._DB_CONN:
-                return self._DB_CONN.executemany(*args)
-        else:
-            c = self._DB_CONN.executemany(*args)
-            return c
+        with DBBase._write_lock:
+            if self._AUTO_COMMIT:
+                with self._DB_CONN:
+                    return self._DB_CONN.executemany(*args)
+            else:
+                c = self._DB_CONN.executemany(*args)
+                return c
 
     def commit(self):
         self._DB_CONN.commit()
@@ -428,7 +739,13 @@ class DBBase:
 
     @classmethod
     def close(cls):
-        cls._DB_CONN.close()
+        # don't lose an open group commit
+        DBBase.end()
+        with DBBase._pool_lock:
+            if DBBase._READ_POOL:
+                DBBase._READ_POOL.close()
+                DBBase._READ_POOL = None
+        DBBase._DB_CONN.close()
 
 if __name__ == '__main__':
     raise RuntimeError("Unit tests not yet implemented")
@@ -25,11 +25,12 @@ else:
 	THUMBNAIL_PATH = os.path.join("db", THUMB_NAME)
 	DB_PATH = os.path.join(DB_ROOT, DB_NAME)
 
-DB_VERSION = [0.26] # a list of accepted db versions. E.g. v3.5 will be backward compatible with v3.1 etc.
+DB_VERSION = [0.30] # a list of accepted db versions. E.g. v3.5 will be backward compatible with v3.1 etc.
 CURRENT_DB_VERSION = DB_VERSION[0]
 REAL_DB_VERSION = DB_VERSION[len(DB_VERSION)-1]
+SQLITE_MAX_VARIABLES = 999 # default SQLITE_MAX_VARIABLE_NUMBER, used to chunk IN (...) queries
+READ_POOL_SIZE = 4 # amount of read connections used alongside the writer connection
 METHOD_QUEUE = None
-METHOD_RETURN = None
 DATABASE = None
 
 class NoDatabaseConnection(Exception): pass
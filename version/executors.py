@@ -1,8 +1,11 @@
-﻿import logging, uuid, os
+﻿import logging, uuid, os, threading, functools, io, hashlib, re, time, contextlib, scandir, struct, mmap
+import multiprocessing
 
 from concurrent import futures
+from concurrent.futures.process import BrokenProcessPool
 from PyQt5.QtCore import Qt
 from PyQt5.QtGui import QImage, QPainter, QBrush, QPen
+from PIL import Image, ImageChops, ImageDraw
 
 from database import db_constants
 import utils
@@ -29,9 +32,64 @@ def _rounded_qimage(qimg, radius):
 	p.end()
 	return r_image
 
+def _pil_open(f, width, height):
+	"""
+	Decodes an image for a thumbnail of width and height. JPEGs are decoded at a reduced scale
+	in the DCT domain with draft, other formats are shrunk with reduce. Both stop at twice the
+	thumbnail size, so the final resample keeps its quality.
+	"""
+	im = Image.open(f)
+	ratio = min(width / im.size[0], height / im.size[1])
+	if ratio < 0.5:
+		im.draft(None, (round(im.size[0] * ratio * 2), round(im.size[1] * ratio * 2)))
+		ratio = min(width / im.size[0], height / im.size[1])
+	factor = int(1 / (ratio * 2))
+	if factor > 1 and im.mode not in ('1', 'P'): # reduce only works on continuous-tone modes
+		im = im.reduce(factor)
+	im.load()
+	return im
+
+def _decode_qimage(f, width, height):
+	"Decodes an image from a file-like object with PIL, falls back to Qt's decoders"
+	try:
+		im_data = utils.PToQImageHelper(_pil_open(f, width, height))
+		image = QImage(im_data['data'], im_data['im'].size[0], im_data['im'].size[1], im_data['format'])
+		if im_data['colortable']:
+			image.setColorTable(im_data['colortable'])
+	except (ValueError, OSError):
+		f.seek(0)
+		image = QImage.fromData(f.read())
+	return image
+
+@contextlib.contextmanager
+def _open_cover(source_args, img=None):
+	"""
+	Opens the cover, the first page of the source or img if set.
+	Yields a file-like object, raises IndexError if there's no cover
+	"""
+	if img:
+		if not os.path.isfile(img):
+			raise IndexError
+		with open(img, 'rb') as f:
+			yield f
+	else:
+		try:
+			source = utils.PageSource(*source_args)
+		except OSError:
+			raise IndexError
+		try:
+			with source.open(source.pages()[0]) as f:
+				yield f
+		finally:
+			source.close()
+
 def _task_thumbnail(gallery_or_path, img=None, width=app_constants.THUMB_W_SIZE,
-						height=app_constants.THUMB_H_SIZE):
+						height=app_constants.THUMB_H_SIZE, force=False):
 	"""
+	Returns the path to the thumbnail of the gallery's cover, or of img if set.
+	The other sizes the UI shows are generated along with it, see ThumbnailStore.variants.
+	Existing thumbnails of the same cover and size are reused, unless force is set.
+	Then they are rendered again and replace the stored ones.
 	"""
 	log_i("Generating thumbnail")
 	# generate a cache dir if required
@@ -39,63 +97,623 @@ def _task_thumbnail(gallery_or_path, img=None, width=app_constants.THUMB_W_SIZE,
 		os.mkdir(db_constants.THUMBNAIL_PATH)
 
 	try:
-		if not img:
-			img_path = utils.get_gallery_img(gallery_or_path)
-		else:
-			img_path = img
-		if not img_path:
-			raise IndexError
-		for ext in utils.IMG_FILES:
-			if img_path.lower().endswith(ext):
-				suff = ext # the image ext with dot
-
-		# generate unique file name
-		file_name = str(uuid.uuid4()) + ".png"
-		new_img_path = os.path.join(db_constants.THUMBNAIL_PATH, (file_name))
-		if not os.path.isfile(img_path):
-			raise IndexError
+		source_args = None if img else utils.PageSource.source_args(gallery_or_path)
+		with _open_cover(source_args, img) as f:
+			variants = ThumbnailStore.variants(utils.generate_img_hash(f),
+									  ThumbnailStore.sizes(width, height), ThumbnailStore.scales())
+			new_img_path = variants[0][0]
+			if force:
+				missing = variants
+			else:
+				missing = [v for v in variants if not ThumbnailStore.lookup(v[0])]
+			if not missing:
+				return new_img_path
+			f.seek(0)
+			image = _decode_qimage(f, *_largest_variant(missing))
 
 		# Do the scaling
-		try:
-			im_data = utils.PToQImageHelper(img_path)
-			image = QImage(im_data['data'], im_data['im'].size[0], im_data['im'].size[1], im_data['format'])
-			if im_data['colortable']:
-				image.setColorTable(im_data['colortable'])
-		except ValueError:
-			image = QImage()
-			image.load(img_path)
 		if image.isNull():
 			raise IndexError
 		radius = 5
-		image = image.scaled(width, height, Qt.KeepAspectRatio, Qt.SmoothTransformation)
-		r_image = _rounded_qimage(image, radius)
-		r_image.save(new_img_path, "PNG", quality=80)
-	except IndexError:
+		for path, (w, h), scale in missing:
+			r_image = _rounded_qimage(image.scaled(w * scale, h * scale, Qt.KeepAspectRatio, Qt.SmoothTransformation),
+							 radius * scale)
+			ThumbnailStore.save(path, lambda p: r_image.save(p, "PNG", quality=80))
+		if force and app_constants.THUMBNAIL_ATLAS:
+			# packed copies would be loaded instead of the new files
+			ThumbnailAtlas.drop([os.path.basename(v[0]) for v in missing])
+	except (IndexError, app_constants.CreateArchiveFail, app_constants.FileNotFoundInArchive):
 		new_img_path = app_constants.NO_IMAGE_PATH
 
 	return new_img_path
 
+def _largest_variant(variants):
+	"Returns the width and height the cover has to be decoded at for all variants"
+	return (max(w * scale for path, (w, h), scale in variants),
+		 max(h * scale for path, (w, h), scale in variants))
+
+def _pil_scaled(im, width, height):
+	"Scales a PIL image to fit within width and height, keeping aspect ratio"
+	ratio = min(width / im.size[0], height / im.size[1])
+	size = (max(1, round(im.size[0] * ratio)), max(1, round(im.size[1] * ratio)))
+	return im.resize(size, Image.LANCZOS)
+
+def _pil_rounded(im, radius):
+	"Same as _rounded_qimage for PIL images. The corner mask is drawn at 4x and scaled down to antialias it"
+	im = im.convert('RGBA')
+	w, h = im.size
+	mask = Image.new('L', (w * 4, h * 4), 0)
+	ImageDraw.Draw(mask).rounded_rectangle((0, 0, w * 4 - 1, h * 4 - 1), radius * 4, fill=255)
+	mask = mask.resize((w, h), Image.LANCZOS)
+	im.putalpha(ImageChops.multiply(im.getchannel('A'), mask))
+	return im
+
+def _task_thumbnail_process(source_args, img=None, width=app_constants.THUMB_W_SIZE,
+							height=app_constants.THUMB_H_SIZE, thumb_dir=None, sizes=None, scales=None):
+	"""
+	Same as _task_thumbnail but only uses PIL, so it can run in a worker process.
+	source_args are the PageSource arguments of the gallery, see PageSource.source_args.
+	thumb_dir, sizes and scales default to this process' settings, pass them explicitly to worker processes.
+	Returns the path to the thumbnail
+	"""
+	thumb_dir = thumb_dir or db_constants.THUMBNAIL_PATH
+	try:
+		with _open_cover(source_args, img) as f:
+			variants = ThumbnailStore.variants(utils.generate_img_hash(f), sizes or ThumbnailStore.sizes(width, height),
+									  scales or ThumbnailStore.scales(), thumb_dir)
+			new_img_path = variants[0][0]
+			missing = [v for v in variants if not ThumbnailStore.lookup(v[0])]
+			if not missing:
+				return new_img_path
+			f.seek(0)
+			im = _pil_open(f, *_largest_variant(missing))
+
+		for path, (w, h), scale in missing:
+			r_im = _pil_rounded(_pil_scaled(im, w * scale, h * scale), 5 * scale)
+			ThumbnailStore.save(path, lambda p: r_im.save(p, "PNG"))
+	except (IndexError, OSError, app_constants.CreateArchiveFail, app_constants.FileNotFoundInArchive):
+		new_img_path = app_constants.NO_IMAGE_PATH
+	except (ValueError, SyntaxError, Image.DecompressionBombError):
+		# PIL's errors for images it can't decode, one bad cover mustn't fail the whole batch
+		log.exception('Could not decode thumbnail cover')
+		new_img_path = app_constants.NO_IMAGE_PATH
+	return new_img_path
+
+def _task_hash_page(source, name):
+	"Returns the digest of a page of source. The page is closed when it's hashed"
+	src = source.src(name)
+	try:
+		return utils.generate_img_hash(src)
+	finally:
+		if isinstance(src, memoryview):
+			src.release()
+		elif hasattr(src, 'close'):
+			src.close()
+
 def _task_load_thumbnail(ppath, thumb_size, on_method=None, **kwargs):
 	if ppath:
-		img = QImage(ppath)
-		if not img.isNull():
-			size = img.size()
-			if size.width() != thumb_size[0]:
-				# TODO: use _task_thumbnail
+		img = QImage()
+		# thumbnails in the store have a variant for every size and scale the UI uses
+		scale = ThumbnailStore.scales()[-1]
+		variant = ThumbnailStore.variant(ppath, thumb_size, scale)
+		if variant:
+			img = ThumbnailStore.qimage(variant)
+			if not img.isNull():
+				ThumbnailStore.touch(variant)
+				img.setDevicePixelRatio(scale)
+		if img.isNull():
+			# older thumbnails are scaled on load
+			img = ThumbnailStore.qimage(ppath)
+			if img.isNull():
+				return
+			ThumbnailStore.touch(ppath)
+			if img.size().width() != thumb_size[0]:
 				img = _rounded_qimage(img.scaled(thumb_size[0], thumb_size[1], Qt.KeepAspectRatio, Qt.SmoothTransformation), 5)
-			if on_method:
-				on_method(img, **kwargs)
-			return img
+		if on_method:
+			on_method(img, **kwargs)
+		return img
+
+class ThumbnailStore:
+	"""
+	Thumbnails are named after the sha1 of their cover's bytes, their size and scale, so identical covers
+	share files and an unchanged cover is never rendered twice. A file's mtime is its last use.
+	Every size the UI shows is generated at once, with 2x variants on high-DPI screens, so loading never scales.
+	Files aren't deleted with their gallery since others may share them, sweep deletes the unused ones.
+	sizes -> returns the sizes to generate along with the given one
+	scales -> returns the scales to generate for this screen
+	variants -> returns (path, size, scale) of all variants of a cover
+	path -> returns the thumbnail path for a cover digest, size and scale
+	variant -> returns the path of another size and scale of a stored thumbnail
+	lookup -> returns True if the thumbnail exists, marking it used
+	exists -> returns True if the thumbnail is a file or packed in the atlas
+	qimage -> loads a thumbnail as QImage
+	save <- writes a thumbnail atomically with the given write method
+	touch <- marks a thumbnail as used
+	is_stored -> returns True if the path is a file of the store
+	enforce_budget <- deletes least recently used thumbnails until within 'thumbnail store budget'
+	used_check -> returns a function telling if a thumbnail is used
+	sweep <- deletes thumbnails not in the given set of used paths
+	"""
+	# cover digest, then size and scale. Thumbnails without size are from before variants
+	_name = re.compile(r'([0-9a-f]{40})(?:_(\d+)x(\d+)(?:@(\d+)x)?)?\.png')
+	_written = 0 # bytes written since the budget was last enforced
+	_lock = threading.Lock()
+
+	@staticmethod
+	def sizes(width, height):
+		sizes = [(width, height)]
+		for s in (app_constants.THUMB_DEFAULT, app_constants.THUMB_SMALL):
+			if s not in sizes:
+				sizes.append(s)
+		return sizes
+
+	@staticmethod
+	def scales():
+		return (1, 2) if app_constants.DEVICE_PIXEL_RATIO > 1 else (1,)
+
+	@classmethod
+	def variants(cls, digest, sizes, scales, thumb_dir=None):
+		"The first variant is the first size at scale 1, it's the one galleries keep as profile"
+		return [(cls.path(digest, s[0], s[1], thumb_dir, scale), s, scale) for scale in scales for s in sizes]
+
+	@staticmethod
+	def path(digest, width, height, thumb_dir=None, scale=1):
+		name = '{}_{}x{}{}.png'.format(digest.hex(), width, height, '@{}x'.format(scale) if scale != 1 else '')
+		return os.path.join(thumb_dir or db_constants.THUMBNAIL_PATH, name)
+
+	@classmethod
+	def variant(cls, path, size, scale=1):
+		"Returns None if path isn't in the store or is from before variants"
+		m = cls._name.fullmatch(os.path.basename(path))
+		if not m or not m.group(2):
+			return None
+		return cls.path(bytes.fromhex(m.group(1)), size[0], size[1], os.path.dirname(path), scale)
+
+	@classmethod
+	def lookup(cls, path):
+		try:
+			os.utime(path)
+			return True
+		except OSError:
+			return app_constants.THUMBNAIL_ATLAS and ThumbnailAtlas.contains(os.path.basename(path))
+
+	@classmethod
+	def exists(cls, path):
+		"Returns True if the thumbnail is a file or packed in the atlas"
+		if os.path.exists(path):
+			return True
+		return app_constants.THUMBNAIL_ATLAS and ThumbnailAtlas.contains(os.path.basename(path))
+
+	@staticmethod
+	def qimage(path):
+		"Loads a thumbnail from the atlas or its file. Returns a null QImage if neither has it"
+		if app_constants.THUMBNAIL_ATLAS:
+			data = ThumbnailAtlas.get(os.path.basename(path))
+			if data:
+				return QImage.fromData(data)
+		return QImage(path)
+
+	@classmethod
+	def touch(cls, path):
+		if cls.is_stored(path):
+			try:
+				os.utime(path)
+			except OSError:
+				pass
+
+	@classmethod
+	def is_stored(cls, path):
+		return bool(path) and bool(cls._name.fullmatch(os.path.basename(path)))
+
+	@classmethod
+	def _key(cls, path):
+		m = cls._name.fullmatch(os.path.basename(path))
+		return m.group(1) if m else None
+
+	@classmethod
+	def save(cls, path, write_method):
+		"""
+		write_method is called with a temporary path, which replaces path when done.
+		Concurrent saves of the same thumbnail are harmless, the last one wins.
+		"""
+		temp_path = '{}.{}.tmp'.format(path, uuid.uuid4().hex)
+		try:
+			write_method(temp_path)
+			os.replace(temp_path, path)
+		except:
+			if os.path.exists(temp_path):
+				os.remove(temp_path)
+			raise
+		budget = app_constants.THUMBNAIL_STORE_BUDGET * 1024 * 1024
+		with cls._lock:
+			cls._written += os.path.getsize(path)
+			enforce = budget and cls._written > budget // 20
+			if enforce:
+				cls._written = 0
+		if enforce:
+			cls.enforce_budget()
+
+	@classmethod
+	def _entries(cls, thumb_dir):
+		try:
+			return [x for x in scandir.scandir(thumb_dir) if x.is_file()]
+		except FileNotFoundError:
+			return []
+
+	@classmethod
+	def enforce_budget(cls, thumb_dir=None):
+		"Deletes the least recently used thumbnails until the store is at 90% of its budget"
+		budget = app_constants.THUMBNAIL_STORE_BUDGET * 1024 * 1024
+		if not budget:
+			return
+		entries = []
+		total = 0
+		for e in cls._entries(thumb_dir or db_constants.THUMBNAIL_PATH):
+			if cls._name.fullmatch(e.name):
+				st = e.stat()
+				entries.append((st.st_mtime, st.st_size, e.path))
+				total += st.st_size
+		if total <= budget:
+			return
+		entries.sort()
+		evicted = 0
+		for mtime, size, path in entries:
+			if total <= budget * 0.9:
+				break
+			try:
+				os.remove(path)
+				evicted += 1
+			except FileNotFoundError:
+				pass
+			total -= size
+		log_i('Evicted {} thumbnails over the store budget'.format(evicted))
+
+	@classmethod
+	def used_check(cls, used):
+		"Returns a function telling if a thumbnail path is in used, a set of normalized paths, or a variant of one"
+		used_keys = set(filter(None, (cls._key(p) for p in used)))
+		return lambda path: os.path.normcase(os.path.abspath(path)) in used or cls._key(path) in used_keys
+
+	@classmethod
+	def sweep(cls, used, grace=3600, thumb_dir=None):
+		"""
+		Deletes thumbnails and leftover temporary files not in used, a set of normalized paths.
+		Files changed within grace seconds are kept, they may belong to galleries not saved yet.
+		"""
+		now = time.time()
+		swept = 0
+		is_used = cls.used_check(used)
+		for e in cls._entries(thumb_dir or db_constants.THUMBNAIL_PATH):
+			if is_used(e.path):
+				continue
+			try:
+				if now - e.stat().st_mtime > grace:
+					os.remove(e.path)
+					swept += 1
+			except FileNotFoundError:
+				pass
+		log_i('Swept {} unused thumbnails'.format(swept))
+
+class ThumbnailAtlas:
+	"""
+	Packs thumbnail files into one data file, so loading a thumbnail is a slice of an mmap and
+	a decode instead of opening a small file. Enabled with the 'thumbnail atlas' setting.
+	Thumbnails are still generated as files, pack moves them into the atlas. Entries are looked up
+	by file name, so gallery profiles keep their paths.
+	The index is a log of (offset, length, name) records appended after the data is written.
+	Its header names the data file, so compact can switch both with one rename.
+	contains -> returns True if a thumbnail is packed
+	get -> returns the bytes of a packed thumbnail, or None
+	pack <- moves the files of the thumbnail directory into the atlas, also migrates existing thumbnails
+	drop <- removes entries
+	sweep <- removes entries not used, see ThumbnailStore.used_check
+	compact <- rewrites the data file without removed entries
+	unpack <- writes all entries back to files and deletes the atlas
+	clear <- deletes the atlas
+	maintain <- sweeps, packs and compacts, or unpacks if the atlas got disabled
+	"""
+	_MAGIC = b'HPATLAS1'
+	_RECORD = struct.Struct('<QIH') # offset, length (0 removes the entry), name length
+	_lock = threading.RLock()
+	_index = None # name -> (offset, length)
+	_index_read = 0 # bytes of the index file read
+	_index_stat = None # (size, mtime) of the index file when read
+	_data_name = None
+	_dead = 0 # bytes of removed or replaced entries
+	_map = None
+
+	@staticmethod
+	def _index_path():
+		return db_constants.THUMBNAIL_PATH + '.atlas'
+
+	@classmethod
+	def _data_path(cls, data_name=None):
+		return os.path.join(os.path.dirname(cls._index_path()), data_name or cls._data_name)
+
+	@classmethod
+	def exists(cls):
+		return os.path.exists(cls._index_path())
+
+	@classmethod
+	def _close_map(cls):
+		if cls._map:
+			cls._map.close()
+		cls._map = None
+
+	@classmethod
+	def _load_index(cls):
+		"Reads records appended since the last read, or the whole index if it was replaced. Hold the lock"
+		try:
+			st = os.stat(cls._index_path())
+			if (st.st_size, st.st_mtime_ns) == cls._index_stat:
+				return
+			with open(cls._index_path(), 'rb') as f:
+				header = f.read(len(cls._MAGIC) + 32)
+				if len(header) < len(cls._MAGIC) + 32 or not header.startswith(cls._MAGIC):
+					raise FileNotFoundError
+				data_name = header[len(cls._MAGIC):].decode('ascii') + '.atlas-data'
+				if data_name != cls._data_name:
+					cls._close_map()
+					cls._index, cls._index_read, cls._data_name, cls._dead = {}, len(header), data_name, 0
+				f.seek(cls._index_read)
+				buf = f.read()
+		except FileNotFoundError:
+			cls._close_map()
+			cls._index, cls._index_read, cls._data_name, cls._dead = {}, 0, None, 0
+			cls._index_stat = None
+			return
+		cls._index_stat = (st.st_size, st.st_mtime_ns)
+		pos = 0
+		while pos + cls._RECORD.size <= len(buf):
+			offset, length, n_len = cls._RECORD.unpack_from(buf, pos)
+			end = pos + cls._RECORD.size + n_len
+			if end > len(buf):
+				break # a record still being written
+			name = buf[pos + cls._RECORD.size:end].decode('utf-8')
+			old = cls._index.pop(name, None)
+			if old:
+				cls._dead += old[1]
+			if length:
+				cls._index[name] = (offset, length)
+			pos = end
+		cls._index_read += pos
+
+	@classmethod
+	def _write_index(cls, path, data_name, records, new=False):
+		"Appends records of (name, offset, length) to the index at path, new starts a new index"
+		with open(path, 'wb' if new else 'r+b') as f:
+			if new:
+				f.write(cls._MAGIC + data_name[:32].encode('ascii'))
+			else:
+				# drop a record left unfinished by a crash
+				f.truncate(cls._index_read)
+				f.seek(cls._index_read)
+			for name, offset, length in records:
+				n = name.encode('utf-8')
+				f.write(cls._RECORD.pack(offset, length, len(n)) + n)
+			f.flush()
+			os.fsync(f.fileno())
+
+	@classmethod
+	def _append(cls, entries):
+		"Appends entries of (name, bytes). Hold the lock"
+		cls._load_index()
+		new = cls._data_name is None
+		data_name = cls._data_name or uuid.uuid4().hex + '.atlas-data'
+		records = []
+		with open(cls._data_path(data_name), 'ab') as f:
+			f.seek(0, io.SEEK_END)
+			offset = f.tell()
+			for name, data in entries:
+				f.write(data)
+				records.append((name, offset, len(data)))
+				offset += len(data)
+			f.flush()
+			os.fsync(f.fileno())
+		cls._write_index(cls._index_path(), data_name, records, new)
+		cls._load_index()
+
+	@classmethod
+	def contains(cls, name):
+		with cls._lock:
+			cls._load_index()
+			return name in cls._index
+
+	@classmethod
+	def get(cls, name):
+		with cls._lock:
+			cls._load_index()
+			entry = cls._index.get(name)
+			if not entry:
+				return None
+			offset, length = entry
+			if not cls._map or len(cls._map) < offset + length:
+				# the data file grew since it was mapped
+				cls._close_map()
+				with open(cls._data_path(), 'rb') as f:
+					cls._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+				if len(cls._map) < offset + length:
+					return None
+			return cls._map[offset:offset + length]
+
+	@classmethod
+	def pack(cls, thumb_dir=None, batch_size=500):
+		"Moves the thumbnail files into the atlas, deleting each file once it's indexed"
+		thumb_dir = thumb_dir or db_constants.THUMBNAIL_PATH
+		files = [e.path for e in ThumbnailStore._entries(thumb_dir) if not e.name.endswith('.tmp')]
+		with cls._lock:
+			for n in range(0, len(files), batch_size):
+				entries = []
+				for path in files[n:n + batch_size]:
+					try:
+						with open(path, 'rb') as f:
+							entries.append((os.path.basename(path), f.read()))
+					except FileNotFoundError:
+						pass
+				if not entries:
+					continue
+				cls._append(entries)
+				for name, data in entries:
+					try:
+						os.remove(os.path.join(thumb_dir, name))
+					except FileNotFoundError:
+						pass
+		if files:
+			log_i('Packed {} thumbnails into the atlas'.format(len(files)))
+
+	@classmethod
+	def drop(cls, names):
+		with cls._lock:
+			cls._load_index()
+			records = [(name, 0, 0) for name in names if name in cls._index]
+			if records:
+				cls._write_index(cls._index_path(), cls._data_name, records)
+				cls._load_index()
+
+	@classmethod
+	def sweep(cls, used):
+		is_used = ThumbnailStore.used_check(used)
+		with cls._lock:
+			cls._load_index()
+			unused = [name for name in cls._index if not is_used(os.path.join(db_constants.THUMBNAIL_PATH, name))]
+			cls.drop(unused)
+		log_i('Swept {} unused thumbnails from the atlas'.format(len(unused)))
+
+	@classmethod
+	def compact(cls, min_dead=0.5):
+		"Rewrites the atlas if at least min_dead of the data file is removed entries"
+		with cls._lock:
+			cls._load_index()
+			if not cls._data_name:
+				return
+			old_data = cls._data_path()
+			size = os.path.getsize(old_data)
+			if not size or cls._dead / size < min_dead:
+				return
+			data_name = uuid.uuid4().hex + '.atlas-data'
+			records = []
+			with open(old_data, 'rb') as src, open(cls._data_path(data_name), 'wb') as dst:
+				for name, (offset, length) in cls._index.items():
+					src.seek(offset)
+					records.append((name, dst.tell(), length))
+					dst.write(src.read(length))
+				dst.flush()
+				os.fsync(dst.fileno())
+			temp_index = cls._index_path() + '.tmp'
+			cls._write_index(temp_index, data_name, records, True)
+			cls._close_map()
+			os.replace(temp_index, cls._index_path())
+			os.remove(old_data)
+			cls._load_index()
+			log_i('Compacted thumbnail atlas from {} to {} bytes'.format(size, os.path.getsize(cls._data_path())))
+
+	@classmethod
+	def unpack(cls, thumb_dir=None):
+		thumb_dir = thumb_dir or db_constants.THUMBNAIL_PATH
+		with cls._lock:
+			cls._load_index()
+			if not os.path.isdir(thumb_dir):
+				os.mkdir(thumb_dir)
+			for name in list(cls._index):
+				with open(os.path.join(thumb_dir, name), 'wb') as f:
+					f.write(cls.get(name))
+			log_i('Unpacked {} thumbnails from the atlas'.format(len(cls._index)))
+			cls.clear()
+
+	@classmethod
+	def clear(cls):
+		with cls._lock:
+			cls._load_index()
+			data_name = cls._data_name
+			cls._close_map()
+			for path in (cls._index_path(), data_name and cls._data_path(data_name)):
+				if path and os.path.exists(path):
+					os.remove(path)
+			cls._load_index()
+
+	@classmethod
+	def maintain(cls, used):
+		"Keeps the atlas in line with the 'thumbnail atlas' setting. Run it on a thread"
+		if app_constants.THUMBNAIL_ATLAS:
+			cls.sweep(used)
+			cls.pack()
+			cls.compact()
+		elif cls.exists():
+			cls.unpack()
 
 class Executors:
 	_thumbnail_exec = futures.ThreadPoolExecutor(3)
 	_profile_exec = futures.ThreadPoolExecutor(2)
-	
+	_hash_exec = futures.ThreadPoolExecutor(app_constants.HASH_THREADS)
+	_thumbnail_procs = None # created on first batch, see _thumbnail_processes
+	_procs_lock = threading.Lock()
+	_pending = {} # (source args or img, width, height) -> future of the running thumbnail job
+	_pending_lock = threading.Lock()
+
+	@classmethod
+	def _coalesced(cls, key, submit):
+		"Returns the future of the running thumbnail job for key, else the future from submit"
+		with cls._pending_lock:
+			f = cls._pending.get(key)
+			if f:
+				return f
+			f = submit()
+			cls._pending[key] = f
+		f.add_done_callback(functools.partial(cls._pending_done, key))
+		return f
+
+	@classmethod
+	def _pending_done(cls, key, f):
+		with cls._pending_lock:
+			if cls._pending.get(key) is f:
+				del cls._pending[key]
+
+	@staticmethod
+	def _thumbnail_key(gallery_or_path, img, width, height):
+		"Requests with the same key share one thumbnail job. Returns None for galleries without chapters"
+		try:
+			return (img or utils.PageSource.source_args(gallery_or_path), width, height)
+		except KeyError:
+			return None
+
+	@classmethod
+	def _thumbnail_processes(cls):
+		"""
+		Returns the process pool for batch thumbnails, or None if 'thumbnail processes' is 0.
+		Workers are spawned, a forked worker could inherit a lock held by one of our threads and hang.
+		"""
+		if app_constants.THUMBNAIL_PROCESSES < 1:
+			return None
+		with cls._procs_lock:
+			if not cls._thumbnail_procs:
+				try:
+					cls._thumbnail_procs = futures.ProcessPoolExecutor(app_constants.THUMBNAIL_PROCESSES,
+														mp_context=multiprocessing.get_context('spawn'))
+				except TypeError: # python < 3.7 can only fork, use the thread pool there
+					return None
+			return cls._thumbnail_procs
+
+	@classmethod
+	def shutdown(cls):
+		"Stops the thumbnail worker processes, queued thumbnails are dropped"
+		with cls._procs_lock:
+			procs, cls._thumbnail_procs = cls._thumbnail_procs, None
+		if procs:
+			try:
+				procs.shutdown(wait=False, cancel_futures=True)
+			except TypeError: # python < 3.9 finishes the queued thumbnails first
+				procs.shutdown(wait=False)
+
 	@classmethod
 	def generate_thumbnail(cls, gallery_or_path, img=None, width=app_constants.THUMB_W_SIZE,
-						height=app_constants.THUMB_H_SIZE, on_method=None, blocking=False):
+						height=app_constants.THUMB_H_SIZE, on_method=None, blocking=False, force=False):
+		"force renders the thumbnail again even if it's stored, see _task_thumbnail"
 		log_i("Generating thumbnail")
-		f = cls._thumbnail_exec.submit(_task_thumbnail, gallery_or_path, img=img, width=width, height=height)
+		submit = lambda: cls._thumbnail_exec.submit(_task_thumbnail, gallery_or_path, img=img, width=width,
+											  height=height, force=force)
+		# a running job may only reuse the old thumbnail
+		key = None if force else cls._thumbnail_key(gallery_or_path, img, width, height)
+		f = cls._coalesced(key, submit) if key else submit()
 		if on_method:
 			f.add_done_callback(on_method)
 		if blocking:
@@ -105,6 +723,76 @@ class Executors:
 
 		log_d("Returning future")
 
+	@classmethod
+	def generate_thumbnails(cls, galleries, on_method=None, batch_size=100):
+		"""
+		Generates thumbnails for a list of galleries. Each gallery's profile is set as soon as its
+		thumbnail is done. on_method is called with lists of up to batch_size finished galleries.
+		Thumbnails are decoded, scaled and encoded in worker processes unless 'thumbnail processes' is 0.
+		"""
+		log_i("Generating {} thumbnails".format(len(galleries)))
+		if not os.path.isdir(db_constants.THUMBNAIL_PATH):
+			os.mkdir(db_constants.THUMBNAIL_PATH)
+		procs = cls._thumbnail_processes()
+		lock = threading.Lock()
+		state = {'remaining':len(galleries), 'done':[]}
+
+		def thumb_done(gallery, f):
+			try:
+				gallery.profile = f.result()
+			except BrokenProcessPool:
+				log.exception("Thumbnail worker process died")
+				with cls._procs_lock:
+					if cls._thumbnail_procs is procs:
+						cls._thumbnail_procs = None
+			except:
+				log.exception("Failed generating thumbnail")
+			batch = None
+			with lock:
+				state['remaining'] -= 1
+				if gallery.profile:
+					state['done'].append(gallery)
+				if len(state['done']) >= batch_size or not state['remaining']:
+					batch, state['done'] = state['done'], []
+			if batch and on_method:
+				on_method(batch)
+			if batch is not None and not state['remaining'] and app_constants.THUMBNAIL_ATLAS:
+				cls._thumbnail_exec.submit(ThumbnailAtlas.pack)
+
+		sizes = ThumbnailStore.sizes(app_constants.THUMB_W_SIZE, app_constants.THUMB_H_SIZE)
+
+		def submit(gallery, key):
+			if procs and key:
+				try:
+					# galleries don't pickle, workers only get what PageSource needs
+					return procs.submit(_task_thumbnail_process, key[0], thumb_dir=db_constants.THUMBNAIL_PATH,
+						sizes=sizes, scales=ThumbnailStore.scales())
+				except (RuntimeError, BrokenProcessPool):
+					pass # pool is gone, use a thread
+			return cls._thumbnail_exec.submit(_task_thumbnail, gallery)
+
+		fs = []
+		for g in galleries:
+			key = cls._thumbnail_key(g, None, app_constants.THUMB_W_SIZE, app_constants.THUMB_H_SIZE)
+			if key:
+				f = cls._coalesced(key, functools.partial(submit, g, key))
+			else:
+				f = submit(g, key)
+			f.add_done_callback(functools.partial(thumb_done, g))
+			fs.append(f)
+		return fs
+
+	@classmethod
+	def hash_pages(cls, source, pages):
+		"""
+		Hashes pages of a PageSource in parallel. hashlib releases the GIL, so reads and hashing overlap.
+		pages is a dict with page number as key and page name as value.
+		Each job opens its own page, so no more pages are open than there are hash threads.
+		Returns a dict with page number as key and digest as value
+		"""
+		fs = {p:cls._hash_exec.submit(_task_hash_page, source, name) for p, name in pages.items()}
+		return {p:f.result() for p, f in fs.items()}
+
 	@classmethod
 	def load_thumbnail(cls, ppath, thumb_size=app_constants.THUMB_DEFAULT, on_method=None, **kwargs):
 		"**kwargs will be passed to on_method"
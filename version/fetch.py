@@ -17,7 +17,7 @@ import re as regex
 
 from PyQt5.QtCore import QObject, pyqtSignal # need this for interaction with main thread
 
-from gallerydb import Gallery, GalleryDB, HashDB, execute
+from gallerydb import Gallery, GalleryDB, HashDB
 import app_constants
 import pewnet
 import settings
@@ -102,7 +102,7 @@ class Fetch(QObject):
 						chap = new_gallery.chapters.create_chapter()
 						chap.title = utils.title_parser(ch)['title']
 						chap.path = os.path.join(path, ch)
-						chap.pages = len([x for x in scandir.scandir(chap.path) if x.name.endswith(utils.IMG_FILES)])
+						chap.pages = utils.page_count(*utils.PageSource.source_args(chap.path))
 						metafile.update(utils.GMetafile(chap.path))
 
 				else: #else assume that all images are in gallery folder
@@ -110,7 +110,7 @@ class Fetch(QObject):
 					chap.title = utils.title_parser(os.path.split(path)[1])['title']
 					chap.path = path
 					metafile.update(utils.GMetafile(chap.path))
-					chap.pages = len(list(scandir.scandir(path)))
+					chap.pages = utils.page_count(path)
 				
 				parsed = utils.title_parser(folder_name)
 			except NotADirectoryError:
@@ -145,18 +145,14 @@ class Fetch(QObject):
 									chap.title = utils.title_parser(g)['title']
 									chap.path = g
 									metafile.update(utils.GMetafile(g, temp_p))
-									arch = utils.ArchiveFile(temp_p)
-									chap.pages = len([x for x in arch.dir_contents(g) if x.endswith(utils.IMG_FILES)])
-									arch.close()
+									chap.pages = utils.page_count(g, temp_p)
 							else:
 								chap = new_gallery.chapters.create_chapter()
 								chap.title = utils.title_parser(os.path.split(path)[1])['title']
 								chap.in_archive = 1
 								chap.path = path
 								metafile.update(utils.GMetafile(path, temp_p))
-								arch = utils.ArchiveFile(temp_p)
-								chap.pages = len(arch.dir_contents(''))
-								arch.close()
+								chap.pages = utils.page_count(new_gallery.path_in_archive, temp_p)
 						else:
 							raise ValueError
 					else:
@@ -359,14 +355,15 @@ class Fetch(QObject):
 			try:
 				if not gallery.hashes:
 					color_img = kwargs['color'] if 'color' in kwargs else False # used for similarity search on EH
-					hash_dict = execute(HashDB.gen_gallery_hash, False, gallery, 0, 'mid', color_img)
+					# hashed on this thread, so the method queue isn't blocked while pages are read
+					hash_dict = HashDB.gen_gallery_hash(gallery, 0, 'mid', color_img)
 					if color_img and 'color' in hash_dict:
-						custom_args['color'] = hash_dict['color'] # will be path to filename
+						custom_args['color'] = hash_dict['color'] # path to file, or image bytes for archives
 						hash = hash_dict['color']
 					elif hash_dict:
-						hash = hash_dict['mid']
+						hash = hash_dict['mid'].hex()
 				else:
-					hash = gallery.hashes[random.randint(0, len(gallery.hashes)-1)]
+					hash = gallery.hashes[random.randint(0, len(gallery.hashes)-1)].hex()
 			except app_constants.CreateArchiveFail:
 				pass
 			if not hash:
@@ -816,6 +816,11 @@ class GridDelegate(QStyledItemDelegate):
                     new_x += offset
                 return new_x
 
+            def logical_size(pixmap):
+                # 2x thumbnails on high-DPI screens have twice the pixels
+                ratio = pixmap.devicePixelRatio()
+                return int(pixmap.width() / ratio), int(pixmap.height() / ratio)
+
             def img_too_big(start_x):
                 txt_layout = misc.text_layout("Thumbnail regeneration needed!", w, self.title_font, self.title_font_m)
 
@@ -829,8 +834,9 @@ class GridDelegate(QStyledItemDelegate):
                 pix_cache = QPixmapCache.find(self.key(loaded_image.cacheKey()))
                 if isinstance(pix_cache, QPixmap):
                     self.image = pix_cache
-                    img_x = center_img(self.image.width())
-                    if self.image.width() > w or self.image.height() > h:
+                    img_w, img_h = logical_size(self.image)
+                    img_x = center_img(img_w)
+                    if img_w > w or img_h > h:
                         img_too_big(img_x)
                     else:
                         if self.image.height() < self.image.width(): #to keep aspect ratio
@@ -841,9 +847,10 @@ class GridDelegate(QStyledItemDelegate):
                                     self.image)
                 else:
                     self.image = QPixmap.fromImage(loaded_image)
-                    img_x = center_img(self.image.width())
+                    img_w, img_h = logical_size(self.image)
+                    img_x = center_img(img_w)
                     QPixmapCache.insert(self.key(loaded_image.cacheKey()), self.image)
-                    if self.image.width() > w or self.image.height() > h:
+                    if img_w > w or img_h > h:
                         img_too_big(img_x)
                     else:
                         if self.image.height() < self.image.width(): #to keep aspect ratio
@@ -1605,11 +1612,10 @@ class MangaViews:
                 g.view = self.view_type
                 if self.view_type != app_constants.ViewType.Duplicate:
                     g.state = app_constants.GalleryState.New
-                if db:
-                    gallerydb.execute(gallerydb.GalleryDB.add_gallery, True, g)
-                else:
-                    if not g.profile:
-                        Executors.generate_thumbnail(g, on_method=g.set_profile)
+                if not db and not g.profile:
+                    Executors.generate_thumbnail(g, on_method=g.set_profile)
+            if db:
+                gallerydb.execute(gallerydb.GalleryDB.add_galleries, True, list(gallery))
             rows = len(gallery)
             self.list_view.gallery_model._gallery_to_add.extend(gallery)
             if record_time:
@@ -1635,8 +1641,7 @@ class MangaViews:
         if isinstance(list_of_gallery, gallerydb.Gallery):
             list_of_gallery = [list_of_gallery]
         log_d('Replacing {} galleries'.format(len(list_of_gallery)))
-        if db_optimize:
-            gallerydb.execute(gallerydb.GalleryDB.begin, True)
+        changes = []
         for gallery in list_of_gallery:
             kwdict = {'title':gallery.title,
              'profile':gallery.profile,
@@ -1652,11 +1657,10 @@ class MangaViews:
              'series_path':gallery.path,
              'chapters':gallery.chapters,
              'exed':gallery.exed}
+            changes.append((gallery.id, kwdict))
 
-            gallerydb.execute(gallerydb.GalleryDB.modify_gallery,
-                             True, gallery.id, **kwdict)
-        if db_optimize:
-            gallerydb.execute(gallerydb.GalleryDB.end, True)
+        # modify_galleries writes everything in one transaction, db_optimize is implied
+        gallerydb.execute(gallerydb.GalleryDB.modify_galleries, True, changes)
 
     def changeTo(self, idx):
         "change view"
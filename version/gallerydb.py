@@ -14,6 +14,7 @@
 
 import datetime
 import os
+import sqlite3
 import enum
 import scandir
 import threading
@@ -21,21 +22,25 @@ import logging
 import queue
 import io
 import uuid
+import time
+from concurrent import futures
 import functools
+import itertools
 import re as regex
 from dateutil import parser as dateparser
 
 from PyQt5.QtCore import QObject, pyqtSignal, QTime
 
-from utils import (today, ArchiveFile, generate_img_hash, delete_path,
+from utils import (today, ArchiveFile, delete_path,
                      ARCHIVE_FILES, get_gallery_img, IMG_FILES)
 from database import db_constants
 from database import db
 from database.db import DBBase
-from executors import Executors
+from executors import Executors, ThumbnailStore, ThumbnailAtlas
 
 import app_constants
 import utils
+import settings
 
 log = logging.getLogger(__name__)
 log_i = log.info
@@ -46,77 +51,140 @@ log_c = log.critical
 
 
 method_queue = queue.PriorityQueue()
-method_return = queue.Queue()
 db_constants.METHOD_QUEUE = method_queue
-db_constants.METHOD_RETURN = method_return
 
 class PriorityObject:
+    "Lower priority runs first. Objects with the same priority keep their insertion order"
+    _counter = itertools.count()
+
     def __init__(self, priority, data):
         self.p = priority
+        self.n = next(self._counter)
         self.data = data
 
     def __lt__(self, other):
-        return self.p < other.p
+        return (self.p, self.n) < (other.p, other.n)
+
+def _run_method(future, method, args, kwargs):
+    "Runs method and puts its result or exception in the future"
+    if not future.set_running_or_notify_cancel():
+        return
+    try:
+        future.set_result(method(*args, **kwargs))
+    except BaseException as e:
+        future.set_exception(e)
+
+def _run_group(first):
+    """
+    Runs consecutive fire-and-forget methods in one transaction (group commit).
+    The group ends when the window or the batch size is exceeded, the queue is empty
+    or a method which returns is next. Returns that method's PriorityObject, if any.
+    Queue items are only marked done after the commit.
+    """
+    window = app_constants.DB_GROUP_COMMIT_MS / 1000
+    deadline = time.monotonic() + window
+    done = 0
+    next_obj = None
+    DBBase.begin_group()
+    try:
+        obj = first
+        while True:
+            future, method, args, kwargs, groupable = obj.data
+            _run_method(future, method, args, kwargs)
+            done += 1
+            if not DBBase._STATE['group'] or done >= app_constants.DB_GROUP_COMMIT_SIZE:
+                break
+            if time.monotonic() >= deadline:
+                break
+            # don't hold the writer while waiting for more work
+            try:
+                obj = method_queue.get_nowait()
+            except queue.Empty:
+                break
+            if not obj.data[4]:
+                next_obj = obj
+                break
+    finally:
+        DBBase.end_group()
+        for x in range(done):
+            method_queue.task_done()
+    if done > 1:
+        log_d('Group committed {} methods'.format(done))
+    return next_obj
 
 def process_methods():
     """
     Methods are objects.
-    Put a list in the method queue where first index is the
-    method. Named arguments are put in a dict.
+    Put a PriorityObject in the method queue where data is a tuple of a future,
+    the method, a tuple of args, a dict of kwargs and a bool telling if the method
+    may be grouped with other fire-and-forget methods in one transaction.
     """
     while True:
-        l = method_queue.get().data
-        log_d('Processing a method from queue...')
-        method = l.pop(0)
-        log_d(method)
-        args = []
-        kwargs = {}
-        get_args = 1
-        no_return = False
-        while get_args:
-            try:
-                a = l.pop(0)
-                if a == 'no return':
-                    no_return = True
-                    continue
-                if isinstance(a, dict):
-                    kwargs = a
-                else:
-                    args.append(a)
-            except IndexError:
-                get_args = 0
-        args = tuple(args)
-        if args and kwargs:
-            r = method(*args, **kwargs)
-        elif args:
-            r = method(*args)
-        elif kwargs:
-            r = method(**kwargs)
-        else:
-            r = method()
-        if not no_return:
-            method_return.put(r)
-        method_queue.task_done()
+        obj = method_queue.get()
+        while obj:
+            log_d('Processing a method from queue...')
+            future, method, args, kwargs, groupable = obj.data
+            log_d(method)
+            if groupable and not DBBase._STATE['active'] and app_constants.DB_GROUP_COMMIT_SIZE > 1:
+                obj = _run_group(obj)
+            else:
+                _run_method(future, method, args, kwargs)
+                method_queue.task_done()
+                obj = None
 
 method_queue_thread = threading.Thread(name='Method Queue Thread', target=process_methods,
                                        daemon=True)
 method_queue_thread.start()
 
-def execute(method, no_return, *args, **kwargs):
+def _log_exception(future):
+    "Logs the exception of a method nobody is waiting for"
+    if not future.cancelled() and future.exception():
+        e = future.exception()
+        log.error('Method in queue failed', exc_info=(type(e), e, e.__traceback__))
+
+def _split_args(args, kwargs):
+    "Dicts passed as positional args are used as named arguments"
+    arg_list = []
+    for a in args:
+        if isinstance(a, dict):
+            kwargs.update(a)
+        else:
+            arg_list.append(a)
+    return tuple(arg_list), kwargs
+
+def submit(method, *args, priority=999, signal=None, _group=False, **kwargs):
+    """
+    Puts method in the method queue. Returns a concurrent.futures.Future
+    which will hold the result or raised exception of the method.
+    Use asyncio.wrap_future to await it.
+    signal: an optional pyqtSignal which will be emitted with the result
+    """
     log_d('Added method to queue')
     log_d('Method name: {}'.format(method.__name__))
-    arg_list = [method]
-    priority = kwargs.pop("priority", 999)
+    args, kwargs = _split_args(args, kwargs)
+    future = futures.Future()
+    if signal:
+        future.add_done_callback(
+            lambda f: signal.emit(f.result()) if not f.cancelled() and not f.exception() else None)
+    method_queue.put(PriorityObject(priority, (future, method, args, kwargs, _group)))
+    return future
+
+def execute(method, no_return, *args, **kwargs):
+    """
+    Puts method in the method queue.
+    Blocks and returns the result of the method if no_return is false.
+    """
+    if not no_return and threading.current_thread() is method_queue_thread:
+        # waiting on the queue from the queue thread would never return
+        kwargs.pop('priority', None)
+        future = futures.Future()
+        _run_method(future, method, *_split_args(args, kwargs))
+        return future.result()
+    future = submit(method, *args, _group=no_return, **kwargs)
     if no_return:
-        arg_list.append('no return')
-    if args:
-        for x in args:
-            arg_list.append(x)
-    if kwargs:
-        arg_list.append(kwargs)
-    method_queue.put(PriorityObject(priority, arg_list))
-    if not no_return:
-        return method_return.get()
+        future.add_done_callback(_log_exception)
+    else:
+        return future.result()
 
 def chapter_map(row, chapter):
     assert isinstance(chapter, Chapter)
@@ -195,19 +263,21 @@ def default_chap_exec(gallery_or_id, chap, only_values=False):
                 'in_archive':in_archive})
     return execute
 
-def default_exec(object):
+def default_exec(object, series_id=None):
+    "Pass a Gallery object. A series_id of None lets the DB assign one"
     object.set_defaults()
     def check(obj):
         if obj == "None":
             return None
         else:
             return obj
-    executing = ["""INSERT INTO series(title, artist, profile, series_path, is_archive, path_in_archive,
+    executing = ["""INSERT INTO series(series_id, title, artist, profile, series_path, is_archive, path_in_archive,
                     info, type, fav, language, rating, status, pub_date, date_added, last_read, link,
                     times_read, db_v, exed, view)
-                VALUES(:title, :artist, :profile, :series_path, :is_archive, :path_in_archive, :info, :type, :fav, :language,
+                VALUES(:series_id, :title, :artist, :profile, :series_path, :is_archive, :path_in_archive, :info, :type, :fav, :language,
                     :rating, :status, :pub_date, :date_added, :last_read, :link, :times_read, :db_v, :exed, :view)""",
                 {
+                'series_id':series_id,
                 'title':check(object.title),
                 'artist':check(object.artist),
                 'profile':str.encode(object.profile),
@@ -237,16 +307,21 @@ class GalleryDB(DBBase):
         rebuild_thumb -> Rebuilds gallery thumbnail
         rebuild_galleries -> Rebuilds the galleries in DB
         modify_gallery -> Modifies gallery with given gallery id
+        modify_galleries -> Modifies several galleries in one transaction
         get_all_gallery -> returns a list of all gallery (<Gallery> class) currently in DB
         get_gallery_by_path -> Returns gallery with given path
         get_gallery_by_id -> Returns gallery with given id
         add_gallery -> adds gallery into db
+        add_galleries -> adds a list of galleries into db in one transaction
+        set_profiles -> saves the thumbnail path of a list of galleries
         set_gallery_title -> changes gallery title
         gallery_count -> returns amount of gallery (can be used for indexing)
         del_gallery -> deletes the gallery with the given id recursively
         check_exists -> Checks if provided string exists
         clear_thumb -> Deletes a thumbnail
         clear_thumb_dir -> Dletes everything in the thumbnail directory
+        get_profiles -> returns the paths of all gallery and list profiles
+        sweep_thumbs -> deletes unused thumbnails and evicts old ones over the store budget
     """
     def __init__(self):
         raise Exception("GalleryDB should not be instantiated")
@@ -258,7 +333,8 @@ class GalleryDB(DBBase):
             log_i('Recreating thumb {}'.format(gallery.title.encode(errors='ignore')))
             if gallery.profile:
                 GalleryDB.clear_thumb(gallery.profile)
-            gallery.profile = Executors.generate_thumbnail(gallery, blocking=True)
+            # stored thumbnails aren't deleted by clear_thumb, they have to be overwritten
+            gallery.profile = Executors.generate_thumbnail(gallery, blocking=True, force=True)
             GalleryDB.modify_gallery(gallery.id,
                 profile=gallery.profile)
         except:
@@ -268,7 +344,15 @@ class GalleryDB(DBBase):
 
     @staticmethod
     def clear_thumb(path):
-        "Deletes a thumbnail"
+        "Deletes a thumbnail. Thumbnails in the store may be shared, unused ones are deleted by sweep_thumbs"
+        if ThumbnailStore.is_stored(path):
+            return
+        GalleryDB._delete_thumb(path)
+
+    @staticmethod
+    def _delete_thumb(path):
+        if app_constants.THUMBNAIL_ATLAS and path:
+            ThumbnailAtlas.drop([os.path.basename(path)])
         try:
             if os.path.samefile(path, app_constants.NO_IMAGE_PATH):
                 return
@@ -287,7 +371,30 @@ class GalleryDB(DBBase):
         "Deletes everything in the thumbnail directory"
         if os.path.exists(db_constants.THUMBNAIL_PATH):
             for thumbfile in scandir.scandir(db_constants.THUMBNAIL_PATH):
-                GalleryDB.clear_thumb(thumbfile.path)
+                GalleryDB._delete_thumb(thumbfile.path)
+        ThumbnailAtlas.clear()
+
+    @classmethod
+    def get_profiles(cls):
+        "Returns a set with the normalized paths of all gallery and list profiles"
+        profiles = set()
+        for sql in ('SELECT profile FROM series', 'SELECT profile FROM list'):
+            cursor = cls.execute(cls, sql)
+            for row in cursor.fetchall():
+                if row['profile']:
+                    profiles.add(os.path.normcase(os.path.abspath(bytes.decode(row['profile']))))
+        return profiles
+
+    @staticmethod
+    def sweep_thumbs():
+        "Deletes thumbnails nothing uses, enforces the thumbnail store budget and maintains the atlas. Run it on a thread"
+        try:
+            used = execute(GalleryDB.get_profiles, False)
+            ThumbnailStore.sweep(used)
+            ThumbnailStore.enforce_budget()
+            ThumbnailAtlas.maintain(used)
+        except:
+            log.exception('Failed sweeping thumbnails')
 
     @staticmethod
     def rebuild_gallery(gallery, thumb=False):
@@ -322,76 +429,100 @@ class GalleryDB(DBBase):
             return False
         return True
 
+    # gallery field, series column, type to assert or None, encode to bytes
+    _SERIES_FIELDS = (
+        ('title', 'title', str, False),
+        ('profile', 'profile', str, True),
+        ('artist', 'artist', str, False),
+        ('info', 'info', str, False),
+        ('type', 'type', str, False),
+        ('fav', 'fav', int, False),
+        ('language', 'language', str, False),
+        ('rating', 'rating', int, False),
+        ('status', 'status', str, False),
+        ('pub_date', 'pub_date', None, False),
+        ('link', 'link', None, False),
+        ('times_read', 'times_read', None, False),
+        ('last_read', 'last_read', None, False),
+        ('series_path', 'series_path', None, True),
+        ('_db_v', 'db_v', None, False),
+        ('exed', 'exed', None, False),
+        ('is_archive', 'is_archive', None, False),
+        ('path_in_archive', 'path_in_archive', None, False),
+        ('view', 'view', None, False),
+        )
+
+    @staticmethod
+    def _series_values(fields):
+        """
+        Returns a dict of series columns and values for the given gallery fields which aren't None.
+        Tags, chapters and hashes are ignored.
+        """
+        values = {}
+        for field, column, f_type, encode in GalleryDB._SERIES_FIELDS:
+            value = fields.get(field)
+            if value != None:
+                if f_type:
+                    assert isinstance(value, f_type)
+                values[column] = str.encode(value) if encode else value
+        return values
+
     @classmethod
     def modify_gallery(cls, series_id, title=None, profile=None, artist=None, info=None, type=None, fav=None,
                    tags=None, language=None, rating=None, status=None, pub_date=None, link=None,
                    times_read=None, last_read=None, series_path=None, chapters=None, _db_v=None,
                    hashes=None, exed=None, is_archive=None, path_in_archive=None, view=None):
         "Modifies gallery with given gallery id"
-        assert isinstance(series_id, int)
-        assert not isinstance(series_id, bool)
-        executing = []
-        if title != None:
-            assert isinstance(title, str)
-            executing.append(["UPDATE series SET title=? WHERE series_id=?", (title, series_id)])
-        if profile != None:
-            assert isinstance(profile, str)
-            executing.append(["UPDATE series SET profile=? WHERE series_id=?", (str.encode(profile), series_id)])
-        if artist != None:
-            assert isinstance(artist, str)
-            executing.append(["UPDATE series SET artist=? WHERE series_id=?", (artist, series_id)])
-        if info != None:
-            assert isinstance(info, str)
-            executing.append(["UPDATE series SET info=? WHERE series_id=?", (info, series_id)])
-        if type != None:
-            assert isinstance(type, str)
-            executing.append(["UPDATE series SET type=? WHERE series_id=?", (type, series_id)])
-        if fav != None:
-            assert isinstance(fav, int)
-            executing.append(["UPDATE series SET fav=? WHERE series_id=?", (fav, series_id)])
-        if language != None:
-            assert isinstance(language, str)
-            executing.append(["UPDATE series SET language=? WHERE series_id=?", (language, series_id)])
-        if rating != None:
-            assert isinstance(rating, int)
-            executing.append(["UPDATE series SET rating=? WHERE series_id=?", (rating, series_id)])
-        if status != None:
-            assert isinstance(status, str)
-            executing.append(["UPDATE series SET status=? WHERE series_id=?", (status, series_id)])
-        if pub_date != None:
-            executing.append(["UPDATE series SET pub_date=? WHERE series_id=?", (pub_date, series_id)])
-        if link != None:
-            executing.append(["UPDATE series SET link=? WHERE series_id=?", (link, series_id)])
-        if times_read != None:
-            executing.append(["UPDATE series SET times_read=? WHERE series_id=?", (times_read, series_id)])
-        if last_read != None:
-            executing.append(["UPDATE series SET last_read=? WHERE series_id=?", (last_read, series_id)])
-        if series_path != None:
-            executing.append(["UPDATE series SET series_path=? WHERE series_id=?", (str.encode(series_path), series_id)])
-        if _db_v != None:
-            executing.append(["UPDATE series SET db_v=? WHERE series_id=?", (_db_v, series_id)])
-        if exed != None:
-            executing.append(["UPDATE series SET exed=? WHERE series_id=?", (exed, series_id)])
-        if is_archive != None:
-            executing.append(["UPDATE series SET is_archive=? WHERE series_id=?", (is_archive, series_id)])
-        if path_in_archive != None:
-            executing.append(["UPDATE series SET path_in_archive=? WHERE series_id=?", (path_in_archive, series_id)])
-        if view != None:
-            executing.append(["UPDATE series SET view=? WHERE series_id=?", (view, series_id)])
-
-        if tags != None:
-            assert isinstance(tags, dict)
-            TagDB.modify_tags(series_id, tags)
-        if chapters != None:
-            assert isinstance(chapters, ChaptersContainer)
-            ChapterDB.update_chapter(chapters)
-
-        if hashes != None:
-            assert isinstance(hashes, Gallery)
-            HashDB.rebuild_gallery_hashes(hashes)
-
-        for query in executing:
-            cls.execute(cls, *query)
+        fields = locals()
+        fields.pop('cls')
+        fields.pop('series_id')
+        GalleryDB.modify_galleries([(series_id, fields)])
+
+    @classmethod
+    def modify_galleries(cls, list_of_changes):
+        """
+        Modifies several galleries in one transaction.
+        Receives a list of (series_id, fields) where fields is a dict with the same
+        names modify_gallery accepts. Galleries with the same changed columns are updated
+        with one executemany.
+        """
+        updates = {}
+        tag_galleries = []
+        chapter_containers = []
+        hash_galleries = []
+        for series_id, fields in list_of_changes:
+            assert isinstance(series_id, int)
+            assert not isinstance(series_id, bool)
+            values = GalleryDB._series_values(fields)
+            if values:
+                updates.setdefault(tuple(values), []).append(tuple(values.values()) + (series_id,))
+
+            tags = fields.get('tags')
+            if tags != None:
+                assert isinstance(tags, dict)
+                weak_gallery = Gallery()
+                weak_gallery.id = series_id
+                weak_gallery.tags = tags
+                tag_galleries.append(weak_gallery)
+            chapters = fields.get('chapters')
+            if chapters != None:
+                assert isinstance(chapters, ChaptersContainer)
+                chapter_containers.append(chapters)
+            hashes = fields.get('hashes')
+            if hashes != None:
+                assert isinstance(hashes, Gallery)
+                hash_galleries.append(hashes)
+
+        with cls.transaction():
+            for columns, executing in updates.items():
+                cls.executemany(cls, 'UPDATE series SET {} WHERE series_id=?'.format(
+                    ', '.join('{}=?'.format(c) for c in columns)), executing)
+            if tag_galleries:
+                TagDB.modify_galleries_tags(tag_galleries)
+            if chapter_containers:
+                ChapterDB.update_chapters(chapter_containers)
+            for g in hash_galleries:
+                HashDB.rebuild_gallery_hashes(g)
 
     @classmethod
     def get_all_gallery(cls, chapters=True, tags=True, hashes=True):
@@ -409,10 +540,14 @@ class GalleryDB(DBBase):
         Map galleries fetched from DB
         """
         gallery_list = []
+        if tags:
+            g_tags = TagDB.get_tags_for_galleries([r['series_id'] for r in gallery_dict])
         for gallery_row in gallery_dict:
             gallery = Gallery()
             gallery.id = gallery_row['series_id']
-            gallery = gallery_map(gallery_row, gallery, chapters, tags, hashes)
+            gallery = gallery_map(gallery_row, gallery, chapters, False, hashes)
+            if tags:
+                gallery.tags = g_tags[gallery.id]
             if not os.path.exists(gallery.path):
                 gallery.dead_link = True
             ListDB.query_gallery(gallery)
@@ -455,9 +590,6 @@ class GalleryDB(DBBase):
         assert isinstance(object, Gallery), "add_gallery method only accepts gallery items"
         log_i('Recevied gallery: {}'.format(object.path.encode(errors='ignore')))
 
-        #TODO: implement mass gallery adding!  User execute_many method for
-        #effeciency!
-
         cursor = cls.execute(cls, *default_exec(object))
         series_id = cursor.lastrowid
         object.id = series_id
@@ -467,6 +599,45 @@ class GalleryDB(DBBase):
             TagDB.add_tags(object)
         ChapterDB.add_chapters(object)
 
+    @classmethod
+    def add_galleries(cls, galleries):
+        """
+        Adds a list of galleries of <Gallery> class into database in one transaction.
+        Series, chapters and tags are inserted in batches. Sets the id on every gallery.
+        """
+        assert isinstance(galleries, (list, tuple)), "add_galleries method only accepts a list of galleries"
+        if not galleries:
+            return
+        log_i('Recevied {} galleries'.format(len(galleries)))
+        with cls.transaction():
+            # ids are assigned here since executemany doesn't give us lastrowid
+            c = cls.execute(cls, 'SELECT IFNULL(MAX(series_id), 0) AS max_id FROM series')
+            next_id = c.fetchone()['max_id'] + 1
+            series = []
+            chapters = []
+            for g_id, g in enumerate(galleries, next_id):
+                assert isinstance(g, Gallery), "add_galleries method only accepts gallery items"
+                g.id = g_id
+                series.append(default_exec(g, g_id)[1])
+                if not g.chapters:
+                    log_w('Gallery has no chapters: {}'.format(g.path.encode(errors='ignore')))
+                for chap in g.chapters:
+                    chapters.append(default_chap_exec(g, chap, True))
+            cls.executemany(cls, default_exec(galleries[0], next_id)[0], series)
+            cls.executemany(cls, 'INSERT INTO chapters VALUES(NULL, ?, ?, ?, ?, ?, ?)', chapters)
+            TagDB.add_tags_for_galleries([g for g in galleries if g.tags])
+
+        no_profile = [g for g in galleries if not g.profile]
+        if no_profile:
+            Executors.generate_thumbnails(no_profile,
+                on_method=lambda gs: execute(GalleryDB.set_profiles, True, gs, priority=0))
+
+    @classmethod
+    def set_profiles(cls, galleries):
+        "Saves the profile of every gallery in the list"
+        executing = [(str.encode(g.profile), g.id) for g in galleries if g.id != None]
+        cls.executemany(cls, 'UPDATE series SET profile=? WHERE series_id=?', executing)
+
     @classmethod
     def gallery_count(cls):
         """
@@ -543,11 +714,14 @@ class ChapterDB(DBBase):
     """
     Provides the following database methods:
         update_chapter -> Updates an existing chapter in DB
+        update_chapters -> Updates all chapters of several ChapterContainers
         add_chapter -> adds chapter into db
         add_chapter_raw -> links chapter to the given seires id, and adds into db
         get_chapters_for_gallery -> returns a dict with chapters linked to the given series_id
+        get_all_chapters -> returns a dict with a ChaptersContainer for every series_id
         get_chapter-> returns a dict with chapter matching the given chapter_number
         get_chapter_id -> returns id of the chapter number
+        update_page_counts <- sets the page count of chapters, dropping hashes of the given ones
         chapter_size -> returns amount of manga (can be used for indexing)
         del_all_chapters <- Deletes all chapters with the given series_id
         del_chapter <- Deletes chapter with the given number from gallery
@@ -571,6 +745,19 @@ class ChapterDB(DBBase):
         else:
             chapters = chapter_container.get_all_chapters()
 
+        ChapterDB._update_chapters(chapters)
+
+    @classmethod
+    def update_chapters(cls, chapter_containers):
+        "Updates all chapters of the given ChapterContainers with one statement"
+        chapters = []
+        for chapter_container in chapter_containers:
+            assert isinstance(chapter_container, ChaptersContainer)
+            chapters.extend(chapter_container.get_all_chapters())
+        ChapterDB._update_chapters(chapters)
+
+    @classmethod
+    def _update_chapters(cls, chapters):
         executing = []
         for chap in chapters:
             new_path = chap.path
@@ -579,6 +766,17 @@ class ChapterDB(DBBase):
         cls.executemany(cls, "UPDATE chapters SET chapter_title=?, chapter_path=?, pages=?, in_archive=? WHERE series_id=? AND chapter_number=?",
             executing)
 
+    @classmethod
+    def update_page_counts(cls, counts, shifted=[]):
+        """
+        Sets the page count of chapters. counts is a list of (pages, series_id, chapter_number).
+        Hashes of the (series_id, chapter_number) chapters in shifted are deleted, their page numbers changed.
+        """
+        with cls.transaction():
+            cls.executemany(cls, 'UPDATE chapters SET pages=? WHERE series_id=? AND chapter_number=?', counts)
+            cls.executemany(cls, """DELETE FROM hashes WHERE chapter_id IN
+                (SELECT chapter_id FROM chapters WHERE series_id=? AND chapter_number=?)""", shifted)
+
     @classmethod
     def add_chapters(cls, gallery_object):
         "Adds chapters linked to gallery into database"
@@ -620,6 +818,23 @@ class ChapterDB(DBBase):
             chapter_map(row, chap)
         return chapters
 
+    @classmethod
+    def get_all_chapters(cls):
+        """
+        Returns a dict with series_id as key and a ChaptersContainer as value
+        for every gallery in DB. Fetches the whole table in one query.
+        """
+        cursor = cls.execute(cls, 'SELECT * FROM chapters ORDER BY series_id, chapter_number')
+        chapters = {}
+        for row in cursor:
+            g_id = row['series_id']
+            try:
+                container = chapters[g_id]
+            except KeyError:
+                container = chapters[g_id] = ChaptersContainer()
+            chap = container.create_chapter(row['chapter_number'])
+            chapter_map(row, chap)
+        return chapters
 
     @classmethod
     def get_chapter(cls, series_id, chap_numb):
@@ -684,12 +899,17 @@ class TagDB(DBBase):
     del_tags <- Deletes the tags with corresponding tag_ids from DB
     del_gallery_tags_mapping <- Deletes the tags and gallery mappings with corresponding series_ids from DB
     get_gallery_tags -> Returns all tags and namespaces found for the given series_id;
+    get_all_gallery_tags -> Returns a dict with the tags of every series_id
+    get_tags_for_galleries -> Returns a dict with the tags of the given series_ids
     get_tag_gallery -> Returns all galleries with the given tag
     get_ns_tags -> "Returns a dict with namespace as key and list of tags as value"
     get_ns_tags_to_gallery -> Returns all galleries linked to the namespace tags. Receives a dict like this: {"namespace":["tag1","tag2"]}
     get_tags_from_namespace -> Returns all galleries linked to the namespace
     add_tags <- Adds the given dict_of_tags to the given series_id
+    add_tags_for_galleries <- Adds the tags of all given galleries
+    clear_cache <- Empties the in-memory tag cache
     modify_tags <- Modifies the given tags
+    modify_galleries_tags <- Replaces the tags of several galleries
     get_all_tags -> Returns all tags in database
     get_all_ns -> Returns all namespaces in database
     """
@@ -715,122 +935,172 @@ class TagDB(DBBase):
         "Returns all tags and namespaces found for the given series_id"
         if not isinstance(series_id, int):
             return {}
-        cursor = cls.execute(cls, 'SELECT tags_mappings_id FROM series_tags_map WHERE series_id=?',
-                (series_id,))
-        tags = {}
-        result = cursor.fetchall()
-        for tag_map_row in result: # iterate all tag_mappings_ids
-            try:
-                if not tag_map_row:
-                    continue
-                # get tag and namespace
-                c = cls.execute(cls, 'SELECT namespace_id, tag_id FROM tags_mappings WHERE tags_mappings_id=?',
-                  (tag_map_row['tags_mappings_id'],))
-                for row in c.fetchall(): # iterate all rows
-                    # get namespace
-                    c = cls.execute(cls, 'SELECT namespace FROM namespaces WHERE namespace_id=?',
-                        (row['namespace_id'],))
-                    try:
-                        namespace = c.fetchone()['namespace']
-                    except TypeError:
-                        continue
+        return TagDB.get_tags_for_galleries([series_id])[series_id]
 
-                    # get tag
-                    c = cls.execute(cls, 'SELECT tag FROM tags WHERE tag_id=?', (row['tag_id'],))
-                    try:
-                        tag = c.fetchone()['tag']
-                    except TypeError:
-                        continue
+    _GALLERY_TAGS_SQL = """SELECT series_tags_map.series_id, namespaces.namespace, tags.tag
+                        FROM series_tags_map
+                        JOIN tags_mappings ON tags_mappings.tags_mappings_id=series_tags_map.tags_mappings_id
+                        JOIN namespaces ON namespaces.namespace_id=tags_mappings.namespace_id
+                        JOIN tags ON tags.tag_id=tags_mappings.tag_id"""
 
-                    # add them to dict
-                    if not namespace in tags:
-                        tags[namespace] = [tag]
-                    else:
-                        # namespace already exists in dict
-                        tags[namespace].append(tag)
-            except IndexError:
-                continue
-        return tags
+    @staticmethod
+    def _map_gallery_tags(cursor, g_tags):
+        "Puts rows of series_id, namespace and tag into the given dict"
+        for row in cursor:
+            tags = g_tags.setdefault(row['series_id'], {})
+            ns = row['namespace']
+            if not ns in tags:
+                tags[ns] = [row['tag']]
+            else:
+                tags[ns].append(row['tag'])
+        return g_tags
+
+    @classmethod
+    def get_all_gallery_tags(cls):
+        """
+        Returns a dict with series_id as key and a dict of tags as value
+        for every gallery in DB. Fetches everything in one joined query.
+        """
+        cursor = cls.execute(cls, cls._GALLERY_TAGS_SQL + ' ORDER BY series_tags_map.series_id')
+        return TagDB._map_gallery_tags(cursor, {})
+
+    @classmethod
+    def get_tags_for_galleries(cls, series_ids):
+        """
+        Returns a dict with series_id as key and a dict of tags as value
+        for the given series_ids. Galleries without tags will map to an empty dict.
+        """
+        ids = [x for x in series_ids if isinstance(x, int)]
+        g_tags = {x:{} for x in ids}
+        chunk_size = db_constants.SQLITE_MAX_VARIABLES
+        for i in range(0, len(ids), chunk_size):
+            chunk = ids[i:i+chunk_size]
+            cursor = cls.execute(cls, cls._GALLERY_TAGS_SQL + ' WHERE series_tags_map.series_id IN ({})'.format(
+                ', '.join('?'*len(chunk))), chunk)
+            TagDB._map_gallery_tags(cursor, g_tags)
+        return g_tags
+
+    # Process-wide interning cache of namespaces, tags and their mappings.
+    # Warmed from DB on first use and kept in sync when new rows are inserted.
+    # Emptied when a transaction is rolled back, since it may hold ids of discarded rows.
+    _cache_lock = threading.RLock()
+    _cache_conn = None
+    _ns_ids = {} # namespace -> namespace_id
+    _ns_names = {} # namespace_id -> namespace
+    _tag_ids = {} # tag -> tag_id
+    _tag_names = {} # tag_id -> tag
+    _map_ids = {} # (namespace_id, tag_id) -> tags_mappings_id
+
+    @classmethod
+    def clear_cache(cls):
+        "Empties the tag cache. It will be rebuilt from DB on next use"
+        with TagDB._cache_lock:
+            for d in (TagDB._ns_ids, TagDB._ns_names, TagDB._tag_ids, TagDB._tag_names, TagDB._map_ids):
+                d.clear()
+            TagDB._cache_conn = None
+
+    @classmethod
+    def _warm_cache(cls):
+        "Fills the tag cache from DB if it's empty or was filled from another connection"
+        with TagDB._cache_lock:
+            if TagDB._cache_conn is cls._DB_CONN:
+                return
+            TagDB.clear_cache()
+            log_d('Warming tag cache')
+            for r in cls.execute(cls, 'SELECT namespace_id, namespace FROM namespaces'):
+                TagDB._ns_ids[r['namespace']] = r['namespace_id']
+                TagDB._ns_names[r['namespace_id']] = r['namespace']
+            for r in cls.execute(cls, 'SELECT tag_id, tag FROM tags'):
+                TagDB._tag_ids[r['tag']] = r['tag_id']
+                TagDB._tag_names[r['tag_id']] = r['tag']
+            for r in cls.execute(cls, 'SELECT tags_mappings_id, namespace_id, tag_id FROM tags_mappings'):
+                TagDB._map_ids[(r['namespace_id'], r['tag_id'])] = r['tags_mappings_id']
+            TagDB._cache_conn = cls._DB_CONN
+
+    @classmethod
+    def _intern(cls, values, what):
+        """
+        Makes sure the given tags or namespaces exist in DB and in cache.
+        what: 'tag' or 'namespace'. Unknown values are inserted in one batch.
+        """
+        if what == 'namespace':
+            ids, names = TagDB._ns_ids, TagDB._ns_names
+        else:
+            ids, names = TagDB._tag_ids, TagDB._tag_names
+        missing = [v for v in dict.fromkeys(values) if not v in ids]
+        if not missing:
+            return
+        cls.executemany(cls, 'INSERT OR IGNORE INTO {0}s({0}) VALUES(?)'.format(what), [(v,) for v in missing])
+        chunk_size = db_constants.SQLITE_MAX_VARIABLES
+        for i in range(0, len(missing), chunk_size):
+            chunk = missing[i:i+chunk_size]
+            c = cls.execute(cls, 'SELECT {0}_id, {0} FROM {0}s WHERE {0} IN ({1})'.format(
+                what, ', '.join('?'*len(chunk))), chunk)
+            for r in c:
+                ids[r[what]] = r['{}_id'.format(what)]
+                names[r['{}_id'.format(what)]] = r[what]
+
+    @classmethod
+    def _intern_mappings(cls, pairs):
+        """
+        Makes sure the given (namespace_id, tag_id) pairs exist in DB and in cache.
+        Unknown pairs are inserted in one batch.
+        """
+        missing = [k for k in dict.fromkeys(pairs) if not k in TagDB._map_ids]
+        if not missing:
+            return
+        cls.executemany(cls, 'INSERT OR IGNORE INTO tags_mappings(namespace_id, tag_id) VALUES(?, ?)', missing)
+        tag_ids = list({k[1] for k in missing})
+        chunk_size = db_constants.SQLITE_MAX_VARIABLES
+        for i in range(0, len(tag_ids), chunk_size):
+            chunk = tag_ids[i:i+chunk_size]
+            c = cls.execute(cls, 'SELECT tags_mappings_id, namespace_id, tag_id FROM tags_mappings WHERE tag_id IN ({})'.format(
+                ', '.join('?'*len(chunk))), chunk)
+            for r in c:
+                TagDB._map_ids[(r['namespace_id'], r['tag_id'])] = r['tags_mappings_id']
 
     @classmethod
     def add_tags(cls, object):
         "Adds the given dict_of_tags to the given series_id"
         assert isinstance(object, Gallery), "Please provide a valid gallery of class gallery"
+        TagDB.add_tags_for_galleries([object])
 
-        series_id = object.id
-        dict_of_tags = object.tags
-
-        def look_exists(tag_or_ns, what):
-            """check if tag or namespace already exists in base
-            returns id, else returns None"""
-            c = cls.execute(cls, 'SELECT {}_id FROM {}s WHERE {} = ?'.format(what, what, what),
-                (tag_or_ns,))
-            try: # exists
-                return c.fetchone()['{}_id'.format(what)]
-            except TypeError: # doesnt exist
-                return None
-            except IndexError:
-                return None
-
-        tags_mappings_id_list = []
-        # first let's add the tags and namespaces to db
-        for namespace in dict_of_tags:
-            tags_list = dict_of_tags[namespace]
-            # don't add if it already exists
+    @classmethod
+    def add_tags_for_galleries(cls, galleries):
+        """
+        Adds the tags of all given galleries to DB.
+        Tags, namespaces and mappings are looked up in the tag cache, unknown ones are inserted in batches.
+        """
+        with TagDB._cache_lock:
+            TagDB._warm_cache()
             try:
-                namespace_id = look_exists(namespace, "namespace")
-                if not namespace_id:
-                    raise ValueError
-            except ValueError:
-                c = cls.execute(cls, 'INSERT INTO namespaces(namespace) VALUES(?)', (namespace,))
-                namespace_id = c.lastrowid
-
-            tags_id_list = []
-            for tag in tags_list:
-                try:
-                    tag_id = look_exists(tag, "tag")
-                    if not tag_id:
-                        raise ValueError
-                except ValueError:
-                    c = cls.execute(cls, 'INSERT INTO tags(tag) VALUES(?)', (tag,))
-                    tag_id = c.lastrowid
-
-                tags_id_list.append(tag_id)
-
-
-            def look_exist_tag_map(tag_id):
-                "Checks DB if the tag_id already exists with the namespace_id, returns id else None"
-                c = cls.execute(cls, 'SELECT tags_mappings_id FROM tags_mappings WHERE namespace_id=? AND tag_id=?',
-                    (namespace_id, tag_id,))
-                try: # exists
-                    return c.fetchone()['tags_mappings_id']
-                except TypeError: # doesnt exist
-                    return None
-                except IndexError:
-                    return None
-
-            # time to map the tags to the namespace now
-            for tag_id in tags_id_list:
-                # First check if tags mappings exists
-                try:
-                    t_map_id = look_exist_tag_map(tag_id)
-                    if t_map_id:
-                        tags_mappings_id_list.append(t_map_id)
-                    else:
-                        raise TypeError
-                except TypeError:
-                    c = cls.execute(cls, 'INSERT INTO tags_mappings(namespace_id, tag_id) VALUES(?, ?)',
-                     (namespace_id, tag_id,))
-                    # add the tags_mappings_id to our list
-                    tags_mappings_id_list.append(c.lastrowid)
-
-        # Lastly we map the series_id to the tags_mappings
-        executing = []
-        for tags_map in tags_mappings_id_list:
-            executing.append((series_id, tags_map,))
-            #cls.execute(cls, 'INSERT INTO series_tags_map(series_id, tags_mappings_id)
-            #VALUES(?, ?)', (series_id, tags_map,))
-        cls.executemany(cls, 'INSERT OR IGNORE INTO series_tags_map(series_id, tags_mappings_id) VALUES(?, ?)', executing)
+                namespaces = []
+                tags = []
+                for g in galleries:
+                    for ns in g.tags:
+                        namespaces.append(ns)
+                        tags.extend(g.tags[ns])
+                TagDB._intern(namespaces, 'namespace')
+                TagDB._intern(tags, 'tag')
+
+                pairs = []
+                g_maps = []
+                for g in galleries:
+                    for ns in g.tags:
+                        ns_id = TagDB._ns_ids[ns]
+                        for tag in g.tags[ns]:
+                            key = (ns_id, TagDB._tag_ids[tag])
+                            pairs.append(key)
+                            g_maps.append((g.id, key))
+                TagDB._intern_mappings(pairs)
+
+                # Lastly we map the series_id to the tags_mappings
+                executing = [(g_id, TagDB._map_ids[key]) for g_id, key in g_maps]
+                cls.executemany(cls, 'INSERT OR IGNORE INTO series_tags_map(series_id, tags_mappings_id) VALUES(?, ?)', executing)
+            except (sqlite3.Error, KeyError):
+                # cache might be out of sync with DB now
+                TagDB.clear_cache()
+                raise
 
     @staticmethod
     def modify_tags(series_id, dict_of_tags):
@@ -846,6 +1116,13 @@ class TagDB(DBBase):
 
         TagDB.add_tags(weak_gallery)
 
+    @classmethod
+    def modify_galleries_tags(cls, galleries):
+        "Replaces the tags of all given galleries with their current tags"
+        with cls.transaction():
+            cls.executemany(cls, 'DELETE FROM series_tags_map WHERE series_id=?', [(g.id,) for g in galleries])
+            TagDB.add_tags_for_galleries(galleries)
+
 
     @staticmethod
     def get_tag_gallery(tag):
@@ -855,28 +1132,19 @@ class TagDB(DBBase):
     @classmethod
     def get_ns_tags(cls):
         "Returns a dict of all tags with namespace as key and list of tags as value"
-        cursor = cls.execute(cls, 'SELECT namespace_id, tag_id FROM tags_mappings')
         ns_tags = {}
-        ns_id_history = {} # to avoid unesseccary DB fetching
-        for t in cursor.fetchall():
-            try:
-                # get namespace
-                if not t['namespace_id'] in ns_id_history:
-                    c = cls.execute(cls, 'SELECT namespace FROM namespaces WHERE namespace_id=?', (t['namespace_id'],))
-                    ns = c.fetchone()['namespace']
-                    ns_id_history[t['namespace_id']] = ns
-                else:
-                    ns = ns_id_history[t['namespace_id']]
-                # get tag
-                c = cls.execute(cls, 'SELECT tag FROM tags WHERE tag_id=?', (t['tag_id'],))
-                tag = c.fetchone()['tag']
-                # put in dict
+        with TagDB._cache_lock:
+            TagDB._warm_cache()
+            for ns_id, tag_id in TagDB._map_ids:
+                try:
+                    ns = TagDB._ns_names[ns_id]
+                    tag = TagDB._tag_names[tag_id]
+                except KeyError:
+                    continue
                 if ns in ns_tags:
                     ns_tags[ns].append(tag)
                 else:
                     ns_tags[ns] = [tag]
-            except:
-                continue
         return ns_tags
 
     @staticmethod
@@ -910,6 +1178,8 @@ class TagDB(DBBase):
         ns = [n['namespace'] for n in cursor.fetchall()]
         return ns
 
+DBBase.on_rollback(TagDB.clear_cache)
+
 class ListDB(DBBase):
     """
     """
@@ -1021,52 +1291,77 @@ class HashDB(DBBase):
     """
     Contains the following methods:
 
-    find_gallery -> returns galleries which matches the given list of hashes
+    find_gallery -> returns the gallery which best matches the given list of hashes
+    find_gallery_candidates -> returns galleries ranked by how many of the given hashes they match
     get_gallery_hashes -> returns all hashes with the given gallery id in a list
+    get_all_gallery_hashes -> returns a dict with a list of hashes for every gallery id
     get_gallery_hash -> returns hash of chapter specified. If page is specified, returns hash of chapter page
     gen_gallery_hashes <- generates hashes for gallery's chapters and inserts them to db
+    gen_hashes_for_galleries <- generates hashes for many galleries in one transaction
+    prefetch_hash_info -> returns chapter ids and existing hashes needed by hash_galleries
+    hash_galleries -> hashes the missing pages of galleries without touching the DB
+    add_hashes <- inserts hash rows in one transaction
+    get_unhashed_galleries -> returns ids of galleries with fewer hashes than pages
+    hash_coverage -> returns how many galleries have all their pages hashed
     rebuild_gallery_hashes <- inserts hashes into DB only if it doesnt already exist
     """
 
+    @classmethod
+    def _hash_chunks(cls, hashes):
+        "Yields chunks of the given unique hashes small enough for an IN clause"
+        chunk_size = db_constants.SQLITE_MAX_VARIABLES
+        for i in range(0, len(hashes), chunk_size):
+            yield hashes[i:i+chunk_size]
+
+    @classmethod
+    def find_gallery_candidates(cls, hashes, limit=None):
+        """
+        Returns a list of (series_id, matches, ratio) for every gallery sharing
+        at least one of the given hashes, best match first.
+        ratio is matches divided by the number of unique hashes given.
+        """
+        assert isinstance(hashes, (list, tuple, set))
+        unique_hashes = list({h for h in hashes if h})
+        if not unique_hashes:
+            return []
+        matches = {}
+        for chunk in cls._hash_chunks(unique_hashes):
+            c = cls.execute(cls, 'SELECT series_id, COUNT(DISTINCT hash) AS matches FROM hashes'
+                ' WHERE hash IN ({}) GROUP BY series_id ORDER BY matches DESC, series_id'.format(', '.join('?'*len(chunk))), chunk)
+            for r in c.fetchall():
+                matches[r['series_id']] = matches.get(r['series_id'], 0) + r['matches']
+        # chunks are already ranked by sql, only needs re-ranking when merged
+        candidates = sorted(matches.items(), key=lambda x: (-x[1], x[0]))
+        if limit:
+            candidates = candidates[:limit]
+        total = len(unique_hashes)
+        return [(g_id, count, count / total) for g_id, count in candidates]
+
     @classmethod
     def find_gallery(cls, hashes):
+        """
+        Returns a weak gallery with the most matching hashes if every given hash
+        is known to the DB, else None
+        """
         assert isinstance(hashes, list)
-        gallery_ids = {}
-        hash_status = []
-        for hash in hashes:
-            r = cls.execute(cls, 'SELECT series_id FROM hashes WHERE hash=?', (hash,))
-            try:
-                g_ids = r.fetchall()
-                for r in g_ids:
-                    g_id = r['series_id']
-                    if g_id not in gallery_ids:
-                        gallery_ids[g_id] = 1
-                    else:
-                        gallery_ids[g_id] = gallery_ids[g_id] + 1
-                if g_ids:
-                    hash_status.append(True)
-                else:
-                    hash_status.append(False)
-            except KeyError:
-                hash_status.append(False)
-            except TypeError:
-                hash_status.append(False)
-
-        if all(hash_status):
-            # the one with most matching hashes
-            g_id = None
-            h_match_count = 0
-            for g in gallery_ids:
-                if gallery_ids[g] > h_match_count:
-                    h_match_count = gallery_ids[h]
-                    g_id = g
-            if g_id:
-                weak_gallery = Gallery()
-                weak_gallery.id = g_id
-                return weak_gallery
+        if not hashes or not all(hashes):
+            return None
+        unique_hashes = list(set(hashes))
+        found = 0
+        for chunk in cls._hash_chunks(unique_hashes):
+            c = cls.execute(cls, 'SELECT COUNT(DISTINCT hash) FROM hashes WHERE hash IN ({})'.format(
+                ', '.join('?'*len(chunk))), chunk)
+            found += c.fetchone()[0]
+        if found != len(unique_hashes):
+            return None
 
+        candidates = HashDB.find_gallery_candidates(unique_hashes, 1)
+        if candidates:
+            weak_gallery = Gallery()
+            weak_gallery.id = candidates[0][0]
+            return weak_gallery
         return None
-    
+
     @classmethod
     def get_gallery_hashes(cls, gallery_id):
         "Returns all hashes with the given gallery id in a list"
@@ -1080,6 +1375,21 @@ class HashDB(DBBase):
             return []
         return hashes
 
+    @classmethod
+    def get_all_gallery_hashes(cls):
+        """
+        Returns a dict with series_id as key and a list of hashes as value
+        for every gallery in DB. Fetches the whole table in one query.
+        """
+        cursor = cls.execute(cls, 'SELECT series_id, hash FROM hashes ORDER BY series_id')
+        g_hashes = {}
+        for row in cursor:
+            try:
+                g_hashes[row['series_id']].append(row['hash'])
+            except KeyError:
+                g_hashes[row['series_id']] = [row['hash']]
+        return g_hashes
+
     @classmethod
     def get_gallery_hash(cls, gallery_id, chapter, page=None):
         """
@@ -1108,7 +1418,25 @@ class HashDB(DBBase):
         return hashes
 
     @classmethod
-    def gen_gallery_hash(cls, gallery, chapter, page=None, color_img=False, _name=None):
+    def _chapter_hashes(cls, series_ids):
+        """
+        Returns a dict with chapter_id as key and a dict of page:hash as value
+        for every chapter of the given gallery ids
+        """
+        chapters = {}
+        chunk_size = db_constants.SQLITE_MAX_VARIABLES
+        for i in range(0, len(series_ids), chunk_size):
+            chunk = series_ids[i:i+chunk_size]
+            c = cls.execute(cls, 'SELECT chapter_id, page, hash FROM hashes WHERE series_id IN ({})'.format(
+                ', '.join('?'*len(chunk))), chunk)
+            for r in c.fetchall():
+                if r['hash'] and r['page'] != None:
+                    chapters.setdefault(r['chapter_id'], {})[r['page']] = r['hash']
+        return chapters
+
+    @classmethod
+    def gen_gallery_hash(cls, gallery, chapter, page=None, color_img=False, _name=None,
+                         _chap_id=None, _existing=None, _executing=None):
         """
         Generate hash for a specific chapter.
         Set page to only generate specific page
@@ -1122,17 +1450,16 @@ class HashDB(DBBase):
             assert isinstance(page, (int, str, list))
         skip_gen = False
         if gallery.id:
-            chap_id = ChapterDB.get_chapter_id(gallery.id, chapter)
-            
-            c = cls.execute(cls, 'SELECT hash, page FROM hashes WHERE series_id=? AND chapter_id=?',
-                   (gallery.id, chap_id,))
-            hashes = {}
-            for r in c.fetchall():
-                try:
+            chap_id = _chap_id if _chap_id != None else ChapterDB.get_chapter_id(gallery.id, chapter)
+            # hashes already in DB for this chapter, fetched once
+            if _existing == None:
+                c = cls.execute(cls, 'SELECT hash, page FROM hashes WHERE series_id=? AND chapter_id=?',
+                       (gallery.id, chap_id,))
+                _existing = {}
+                for r in c.fetchall():
                     if r['hash'] and r['page'] != None:
-                        hashes[r['page']] = r['hash']
-                except TypeError:
-                    pass
+                        _existing[r['page']] = r['hash']
+            hashes = dict(_existing)
             if isinstance(page, (int, list)):
                 if isinstance(page, int):
                     _page = [page]
@@ -1160,18 +1487,6 @@ class HashDB(DBBase):
 
         if not skip_gen or color_img:
 
-            def look_exists(page):
-                """check if hash already exists in database
-                returns hash, else returns None"""
-                c = cls.execute(cls, 'SELECT hash FROM hashes WHERE page=? AND chapter_id=?',
-                       (page, chap_id,))
-                try: # exists
-                    return c.fetchone()['hash']
-                except TypeError: # doesnt exist
-                    return None
-                except IndexError:
-                    return None
-
             if gallery.dead_link:
                 log_e("Could not generate hash of dead gallery: {}".format(gallery.title.encode(errors='ignore')))
                 return {}
@@ -1186,103 +1501,57 @@ class HashDB(DBBase):
                     return {}
                 
             executing = []
-            try:
-                if gallery.is_archive:
-                    raise NotADirectoryError
-                imgs = sorted([x.path for x in scandir.scandir(chap.path) if x.path.endswith(utils.IMG_FILES)])
-                pages = {}
-                for n, i in enumerate(imgs):
-                    pages[n] = i
 
-                if page != None:
-                    pages = {}
-                    if color_img:
-                        # if first img is colored, then return filepath of that
-                        if not utils.image_greyscale(imgs[0]):
-                            return {'color':imgs[0]}
-                    if page == 'mid':
-                        imgs = imgs[len(imgs) // 2]
-                        pages[len(imgs) // 2] = imgs
-                    elif isinstance(page, list):
-                        try:
-                            for p in page:
-                                pages[p] = imgs[p]
-                        except IndexError:
-                            raise app_constants.InternalPagesMismatch
-                    else:
-                        imgs = imgs[page]
-                        pages = {page:imgs}
-
-                hashes = {}
+            def hash_missing(pages, source):
+                """
+                Hashes the pages not already in DB on the hash pool.
+                Returns a dict with page number as key and hash as value
+                """
+                known = {}
                 if gallery.id != None:
-                    for p in pages:
-                        h = look_exists(p)
-                        if not h:
-                            with open(pages[p], 'rb') as f:
-                                h = generate_img_hash(f)
-                            executing.append((h, gallery.id, chap_id, p,))
-                        hashes[p] = h
-                else:
-                    for i in pages:
-                        with open(pages[i], 'rb') as f:
-                            hashes[i] = generate_img_hash(f)
-
-            except NotADirectoryError:
-                temp_dir = os.path.join(app_constants.temp_dir, str(uuid.uuid4()))
-                is_archive = gallery.is_archive
-                try:
-                    if is_archive:
-                        zip = ArchiveFile(gallery.path)
-                    else:
-                        zip = ArchiveFile(chap.path)
-                except app_constants.CreateArchiveFail:
-                    log_e('Could not generate hash: CreateZipFail')
-                    return {}
+                    known = {p:_existing[p] for p in pages if _existing.get(p)}
+                missing = {p:pages[p] for p in pages if p not in known}
+                new_hashes = Executors.hash_pages(source, missing)
+                if gallery.id != None:
+                    for p, h in new_hashes.items():
+                        executing.append((h, gallery.id, chap_id, p,))
+                known.update(new_hashes)
+                return {p:known[p] for p in pages}
 
-                pages = {}
+            try:
+                source = utils.PageSource.for_gallery(gallery, chapter)
+            except (app_constants.CreateArchiveFail, NotADirectoryError):
+                log_e('Could not generate hash: CreateZipFail')
+                return {}
+            try:
+                imgs = source.pages()
+                pages = dict(enumerate(imgs))
                 if page != None:
-                    p = 0
-                    con = sorted(zip.dir_contents(chap.path))
                     if color_img:
-                        # if first img is colored, then return hash of that
-                        f_bytes = io.BytesIO(zip.open(con[0], False))
-                        if not utils.image_greyscale(f_bytes):
-                            return {'color':zip.extract(con[0])}
-                        f_bytes.close()
-                    if page == 'mid':
-                        p = len(con) // 2
-                        img = con[p]
-                        pages = {p:zip.open(img, True)}
-                    elif isinstance(page, list):
-                        for x in page:
-                            pages[x] = zip.open(con[x], True)
-                    else:
-                        p = page
-                        img = con[p]
-                        pages = {p:zip.open(img, True)}
-
-
-                else:
-                    imgs = sorted(zip.dir_contents(chap.path))
-                    for n, img in enumerate(imgs):
-                        pages[n] = zip.open(img, True)
-                zip.close()
-
-                hashes = {}
-                if gallery.id != None:
-                    for p in pages:
-                        h = look_exists(p)
-                        if not h:
-                            h = generate_img_hash(pages[p])
-                            executing.append((h, gallery.id, chap_id, p,))
-                        hashes[p] = h
-                else:
-                    for i in pages:
-                        hashes[i] = generate_img_hash(pages[i])
+                        # if first img is colored, then return that. A path for folders, bytes for archives
+                        with source.open(imgs[0]) as f:
+                            if not utils.image_greyscale(f):
+                                return {'color':source.read(imgs[0]) if source.in_archive else imgs[0]}
+                    try:
+                        if page == 'mid':
+                            pages = {len(imgs) // 2:imgs[len(imgs) // 2]}
+                        elif isinstance(page, list):
+                            pages = {p:imgs[p] for p in page}
+                        else:
+                            pages = {page:imgs[page]}
+                    except IndexError:
+                        raise app_constants.InternalPagesMismatch
+                # only pages which aren't hashed yet are read
+                hashes = hash_missing(pages, source)
+            finally:
+                source.close()
 
             if executing:
-                cls.executemany(cls, 'INSERT INTO hashes(hash, series_id, chapter_id, page) VALUES(?, ?, ?, ?)',
-                       executing)
+                if _executing != None:
+                    _executing.extend(executing)
+                else:
+                    # pages may be hashed on any thread, only the insert goes through the method queue
+                    execute(HashDB.add_hashes, True, executing)
 
 
         if page == 'mid':
@@ -1302,6 +1571,98 @@ class HashDB(DBBase):
         "Generates hashes for gallery's first chapter and inserts them to DB"
         return HashDB.gen_gallery_hash(gallery, 0)
 
+    @classmethod
+    def gen_hashes_for_galleries(cls, galleries, all_chapters=False):
+        """
+        Generates hashes for the first chapter, or all chapters, of the given galleries
+        and inserts them to DB in one transaction.
+        Existing hashes and chapter ids are fetched up front, so only missing pages are hashed.
+        Pages are hashed before the transaction starts.
+        Returns a dict with gallery id as key and a dict of chapter number:hashes as value
+        """
+        galleries = [g for g in galleries if g.id != None]
+        prefetched = HashDB.prefetch_hash_info([g.id for g in galleries])
+        g_hashes, executing = HashDB.hash_galleries(galleries, prefetched, all_chapters)
+        # no transaction is held while pages are read and hashed
+        HashDB.add_hashes(executing)
+        return g_hashes
+
+    @classmethod
+    def prefetch_hash_info(cls, series_ids):
+        """
+        Returns a tuple of a dict with (series_id, chapter_number) as key and chapter_id as value,
+        and a dict with chapter_id as key and a dict of page:hash as value
+        """
+        chap_ids = {}
+        chunk_size = db_constants.SQLITE_MAX_VARIABLES
+        for i in range(0, len(series_ids), chunk_size):
+            chunk = series_ids[i:i+chunk_size]
+            c = cls.execute(cls, 'SELECT series_id, chapter_number, chapter_id FROM chapters WHERE series_id IN ({})'.format(
+                ', '.join('?'*len(chunk))), chunk)
+            for r in c.fetchall():
+                chap_ids[(r['series_id'], r['chapter_number'])] = r['chapter_id']
+        return chap_ids, HashDB._chapter_hashes(series_ids)
+
+    @staticmethod
+    def hash_galleries(galleries, prefetched, all_chapters=False):
+        """
+        Hashes the missing pages of the given galleries without touching the DB.
+        prefetched is what prefetch_hash_info returned for the galleries.
+        Returns a dict with gallery id as key and a dict of chapter number:hashes as value,
+        and a list of rows to pass to add_hashes
+        """
+        chap_ids, existing = prefetched
+        g_hashes = {}
+        executing = []
+        for g in galleries:
+            numbers = [c.number for c in g.chapters] if all_chapters else [0]
+            for n in numbers:
+                chap_id = chap_ids.get((g.id, n))
+                if chap_id == None:
+                    continue
+                try:
+                    hashes = HashDB.gen_gallery_hash(g, n, _chap_id=chap_id,
+                                                     _existing=existing.get(chap_id, {}), _executing=executing)
+                except (OSError, app_constants.InternalPagesMismatch):
+                    log.exception('Could not generate hashes for gallery: {}'.format(
+                        g.title.encode(errors='ignore')))
+                    continue
+                g_hashes.setdefault(g.id, {})[n] = hashes
+        return g_hashes, executing
+
+    @classmethod
+    def add_hashes(cls, executing):
+        "Inserts a list of (hash, series_id, chapter_id, page) into DB in one transaction"
+        if not executing:
+            return
+        with cls.transaction():
+            cls.executemany(cls, 'INSERT OR IGNORE INTO hashes(hash, series_id, chapter_id, page) VALUES(?, ?, ?, ?)',
+                            executing)
+
+    _UNHASHED_SQL = """
+        SELECT series_id FROM series WHERE series_id > ? AND
+            (SELECT COUNT(*) FROM hashes WHERE hashes.series_id=series.series_id) <
+            (SELECT IFNULL(SUM(pages), 0) FROM chapters WHERE chapters.series_id=series.series_id)
+        ORDER BY series_id LIMIT ?
+        """
+
+    @classmethod
+    def get_unhashed_galleries(cls, after_id=0, limit=50):
+        "Returns ids of galleries with fewer hashes than pages, ordered by id"
+        c = cls.execute(cls, cls._UNHASHED_SQL, (after_id, limit))
+        return [r['series_id'] for r in c.fetchall()]
+
+    @classmethod
+    def hash_coverage(cls):
+        "Returns a tuple of (galleries with all pages hashed, all galleries)"
+        c = cls.execute(cls, """
+            SELECT COUNT(*) AS total, IFNULL(SUM(
+                (SELECT COUNT(*) FROM hashes WHERE hashes.series_id=series.series_id) >=
+                (SELECT IFNULL(SUM(pages), 0) FROM chapters WHERE chapters.series_id=series.series_id)), 0) AS hashed
+            FROM series""")
+        r = c.fetchone()
+        return r['hashed'], r['total']
+
     @staticmethod
     def rebuild_gallery_hashes(gallery):
         "Inserts hashes into DB only if it doesnt already exist"
@@ -1317,6 +1678,26 @@ class HashDB(DBBase):
         "Deletes all hashes linked to the given gallery id"
         cls.execute(cls, 'DELETE FROM hashes WHERE series_id=?', (gallery_id,))
 
+class ManifestDB(DBBase):
+    """
+    Contains the following methods:
+
+    get_manifest -> returns the stored manifest row of an archive path
+    set_manifest <- stores the manifest of an archive path
+    """
+
+    @classmethod
+    def get_manifest(cls, path):
+        "Returns a row with size, mtime, members and galleries, or None"
+        c = cls.execute(cls, 'SELECT size, mtime, members, galleries FROM archive_manifests WHERE path=?', (path,))
+        return c.fetchone()
+
+    @classmethod
+    def set_manifest(cls, path, size, mtime, members, galleries=None):
+        "Stores the manifest of an archive path, replacing any older one"
+        cls.execute(cls, """INSERT OR REPLACE INTO archive_manifests(path, size, mtime, members, galleries)
+            VALUES(?, ?, ?, ?, ?)""", (path, size, mtime, members, galleries))
+
 class GalleryList:
     """
     Provides access to lists..
@@ -1510,6 +1891,7 @@ class Gallery:
         self._list_view_selected = False
         self._profile_qimage = {}
         self._profile_load_status = {}
+        self._profile_regenerating = False
         self.dead_link = False
         self.state = app_constants.GalleryState.Default
         self.qtime = QTime() # used by views to record addition
@@ -1553,6 +1935,12 @@ class Gallery:
                 return
             if f.result():
                 return f.result()
+            if self.profile and not ThumbnailStore.exists(self.profile):
+                # evicted from the thumbnail store, generate it again
+                if not self._profile_regenerating:
+                    self._profile_regenerating = True
+                    Executors.generate_thumbnail(self, on_method=self._profile_regenerated)
+                return
         img = self._profile_load_status.get(ptype)
         if not img:
             self._profile_qimage[ptype] = Executors.load_thumbnail(self.profile, psize,
@@ -1561,6 +1949,11 @@ class Gallery:
 
         return img
 
+    def _profile_regenerated(self, future):
+        self.set_profile(future)
+        self._profile_regenerating = False
+        self.reset_profile()
+
     def set_profile(self, future):
         "set with profile with future object"
         self.profile = future.result()
@@ -1973,12 +2366,7 @@ class ChaptersContainer:
         if self.parent.dead_link:
             return False
         chap = self[number]
-        if chap.in_archive:
-            _archive = utils.ArchiveFile(chap.gallery.path)
-            chap.pages = len([x for x in _archive.dir_contents(chap.path) if x.endswith(IMG_FILES)])
-            _archive.close()
-        else:
-            chap.pages = len([x for x in scandir.scandir(chap.path) if x.path.endswith(IMG_FILES)])
+        chap.pages = utils.page_count(*utils.PageSource.source_args(self.parent, number))
 
         execute(ChapterDB.update_chapter, True, self, [chap.number])
         return True
@@ -2048,7 +2436,7 @@ class AdminDB(QObject):
     def from_v021_to_v022(self, old_db_path=db_constants.DB_PATH):
         log_i("Started rebuilding database")
         if DBBase._DB_CONN:
-            DBBase._DB_CONN.close()
+            DBBase.close()
         DBBase._DB_CONN = db.init_db(old_db_path)
         db_galleries = execute(GalleryDB.get_all_gallery, False, False, True, True)
         galleries = []
@@ -2083,11 +2471,9 @@ class AdminDB(QObject):
                     chap.path = c_path
                     chap.in_archive = chap_row['in_archive']
                     if gallery.is_archive:
-                        zip = utils.ArchiveFile(gallery.path)
-                        chap.pages = len(zip.dir_contents(chap.path))
-                        zip.close()
+                        chap.pages = utils.page_count(chap.path, gallery.path)
                     else:
-                        chap.pages = len(list(scandir.scandir(gallery.path)))
+                        chap.pages = utils.page_count(gallery.path)
                     n_galleries.append(gallery)
                     galleries.remove(gallery)
                     break
@@ -2102,7 +2488,7 @@ class AdminDB(QObject):
                     os.rmdir(os.path.join(root, name))
 
         head = os.path.split(old_db_path)[0]
-        DBBase._DB_CONN.close()
+        DBBase.close()
         t_db_path = os.path.join(head, 'temp.db')
         conn = db.init_db(t_db_path)
         DBBase._DB_CONN = conn
@@ -2112,7 +2498,7 @@ class AdminDB(QObject):
             self.PROGRESS.emit(n)
 
         conn.commit()
-        conn.close()
+        DBBase.close()
 
         log_i("Cleaning up...")
         if os.path.exists(old_db_path):
@@ -2134,24 +2520,26 @@ class AdminDB(QObject):
         log_i("Getting galleries...")
         galleries = GalleryDB.get_all_gallery()
         self.DATA_COUNT.emit(len(galleries))
-        db.DBBase._DB_CONN.close()
+        db.DBBase.close()
         log_i("Removing old database...")
         log_i("Initiating new database...")
         temp_db = os.path.join(db_constants.DB_ROOT, "happypanda_temp.db")
         if os.path.exists(temp_db):
             os.remove(temp_db)
         db.DBBase._DB_CONN = db.init_db(temp_db)
-        DBBase.begin()
         log_i("Adding galleries...")
         GalleryDB.clear_thumb_dir()
-        for n, g in enumerate(galleries):
+        batch = []
+        for n, g in enumerate(galleries, 1):
             if not os.path.exists(g.path):
                 log_i("Gallery doesn't exist anymore: {}".format(g.title.encode(errors="ignore")))
             else:
-                GalleryDB.add_gallery(g)
-            self.PROGRESS.emit(n)
-        DBBase.end()
-        DBBase._DB_CONN.close()
+                batch.append(g)
+            if len(batch) >= 500 or n == len(galleries):
+                GalleryDB.add_galleries(batch)
+                batch = []
+                self.PROGRESS.emit(n)
+        DBBase.close()
         os.remove(db_constants.DB_PATH)
         os.rename(temp_db, db_constants.DB_PATH)
         db.DBBase._DB_CONN = db.init_db(db_constants.DB_PATH)
@@ -2186,6 +2574,147 @@ class AdminDB(QObject):
             self.PROGRESS.emit(n)
         self.DONE.emit(True)
 
+class HashIndexer(QObject):
+    """
+    Hashes all pages of galleries lacking hashes in the background.
+    Only works while the DB method queue is idle and sleeps between galleries. Progress is kept in
+    settings, so a restart resumes after the last indexed gallery.
+    Coverage is counted in DB once on start and then updated from the indexed galleries,
+    so galleries hashed elsewhere meanwhile are only counted on the next start.
+    Before the first indexing the page counts of all galleries are checked once, see _recount_pages.
+    RECOUNT_PROGRESS: emitted with (galleries checked, galleries to check)
+    PROGRESS: emitted with (galleries with all pages hashed, all galleries)
+    DONE: emitted when all galleries have been walked or indexing was stopped
+    """
+    RECOUNT_PROGRESS = pyqtSignal(int, int)
+    PROGRESS = pyqtSignal(int, int)
+    DONE = pyqtSignal()
+
+    def __init__(self):
+        super().__init__()
+        self._batch_size = 20
+        self._stopped = False
+
+    def stop(self):
+        self._stopped = True
+
+    def _wait_idle(self):
+        "Sleeps for the configured delay, then until the method queue is empty"
+        time.sleep(app_constants.HASH_INDEXER_DELAY / 1000)
+        while not method_queue.empty() and not self._stopped:
+            time.sleep(0.5)
+
+    def _save_position(self, series_id):
+        settings.set(series_id, 'Application', 'hash indexer position')
+        settings.save()
+
+    @staticmethod
+    def _is_hashed(gallery, prefetched, executing):
+        "Returns True if the prefetched and new hashes of gallery cover all its pages"
+        chap_ids, existing = prefetched
+        n_hashes = len(executing)
+        for chap in gallery.chapters:
+            n_hashes += len(existing.get(chap_ids.get((gallery.id, chap.number)), {}))
+        return n_hashes >= sum(chap.pages for chap in gallery.chapters)
+
+    @staticmethod
+    def _count_pages(gallery):
+        """
+        Returns a list of (pages, series_id, chapter_number) of the chapters whose count changed,
+        and a list of (series_id, chapter_number) of the folder chapters whose page numbers shifted.
+        Folder pages used to be matched case-sensitively, so hashes of folders which gain pages are stale.
+        """
+        counts = []
+        shifted = []
+        for chap in gallery.chapters:
+            try:
+                source = utils.PageSource.for_gallery(gallery, chap.number)
+            except (OSError, app_constants.CreateArchiveFail, app_constants.FileNotFoundInArchive):
+                continue
+            try:
+                pages = source.pages()
+            finally:
+                source.close()
+            if len(pages) != chap.pages:
+                counts.append((len(pages), gallery.id, chap.number))
+                chap.pages = len(pages)
+            if not source.in_archive and len([x for x in pages if x.endswith(IMG_FILES)]) != len(pages):
+                shifted.append((gallery.id, chap.number))
+        return counts, shifted
+
+    def _recount_pages(self):
+        """
+        Recounts the pages of all galleries once, the way PageSource lists them.
+        Page counts used to include directories and non-image members, so they didn't match
+        the hashed pages. Progress is kept in settings, -1 once all galleries are checked.
+        """
+        position = settings.get(0, 'Application', 'page recount position', int)
+        if position < 0:
+            return
+        log_i('Recounting pages from gallery id: {}'.format(position))
+        galleries = sorted([g for g in app_constants.GALLERY_DATA if g.id != None and g.id > position],
+                           key=lambda g: g.id)
+        for n in range(0, len(galleries), self._batch_size):
+            self._wait_idle()
+            if self._stopped:
+                return
+            batch = galleries[n:n+self._batch_size]
+            counts = []
+            shifted = []
+            for g in batch:
+                if g.dead_link:
+                    continue
+                g_counts, g_shifted = self._count_pages(g)
+                counts.extend(g_counts)
+                shifted.extend(g_shifted)
+                if g_shifted:
+                    g.hashes = []
+            if counts or shifted:
+                execute(ChapterDB.update_page_counts, False, counts, shifted)
+            settings.set(batch[-1].id, 'Application', 'page recount position')
+            settings.save()
+            self.RECOUNT_PROGRESS.emit(n+len(batch), len(galleries))
+        settings.set(-1, 'Application', 'page recount position')
+        settings.save()
+        log_i('Recounted pages of {} galleries'.format(len(galleries)))
+
+    def start(self):
+        self._recount_pages()
+        if self._stopped:
+            self.DONE.emit()
+            return
+        position = settings.get(0, 'Application', 'hash indexer position', int)
+        log_i('Starting hash indexer from gallery id: {}'.format(position))
+        hashed, total = execute(HashDB.hash_coverage, False)
+        self.PROGRESS.emit(hashed, total)
+        while not self._stopped:
+            g_ids = execute(HashDB.get_unhashed_galleries, False, position, self._batch_size)
+            if not g_ids:
+                # walked everything, next start checks from the beginning again
+                self._save_position(0)
+                break
+            galleries = {g.id:g for g in app_constants.GALLERY_DATA}
+            prefetched = execute(HashDB.prefetch_hash_info, False, g_ids)
+            for g_id in g_ids:
+                self._wait_idle()
+                if self._stopped:
+                    break
+                position = g_id
+                g = galleries.get(g_id)
+                if not g or g.dead_link:
+                    continue
+                g_hashes, executing = HashDB.hash_galleries([g], prefetched, True)
+                if executing:
+                    execute(HashDB.add_hashes, True, executing)
+                if self._is_hashed(g, prefetched, executing):
+                    hashed += 1
+                if not g.hashes and g_id in g_hashes:
+                    g.hashes = [h for c in g_hashes[g_id].values() for h in c.values()]
+            self._save_position(position)
+            self.PROGRESS.emit(min(hashed, total), total)
+        log_i('Hash indexer stopped at gallery id: {}'.format(position))
+        self.DONE.emit()
+
 class DatabaseStartup(QObject):
     """
     Fetches and emits database records
@@ -2243,17 +2772,31 @@ class DatabaseStartup(QObject):
                     view.gallery_model._gallery_to_add = view_galleries
                     view.gallery_model.insertRows(view.gallery_model.rowCount(), len(view_galleries))
 
+    def _map_to_galleries(self, data, attr, progress_txt):
+        """
+        Sets attr on the loaded galleries from a dict with series_id as key.
+        Galleries without a matching key keep their default value.
+        """
+        total = len(self._loaded_galleries)
+        for n, g in enumerate(self._loaded_galleries, 1):
+            try:
+                setattr(g, attr, data[g.id])
+            except KeyError:
+                pass
+            if not n % self._fetch_count:
+                self.PROGRESS.emit(progress_txt.format(total - n))
+
     def fetch_chapters(self):
-        for g in self._loaded_galleries:
-            g.chapters = execute(ChapterDB.get_chapters_for_gallery, False, g.id)
+        chapters = execute(ChapterDB.get_all_chapters, False)
+        self._map_to_galleries(chapters, 'chapters', "Loading chapters: {}")
 
     def fetch_tags(self):
-        for g in self._loaded_galleries:
-            g.tags = execute(TagDB.get_gallery_tags, False, g.id)
+        tags = execute(TagDB.get_all_gallery_tags, False)
+        self._map_to_galleries(tags, 'tags', "Loading tags: {}")
 
     def fetch_hashes(self):
-        for g in self._loaded_galleries:
-            g.hashes = execute(HashDB.get_gallery_hashes, False, g.id)
+        hashes = execute(HashDB.get_all_gallery_hashes, False)
+        self._map_to_galleries(hashes, 'hashes', "Loading hashes: {}")
 
 
 if __name__ == '__main__':
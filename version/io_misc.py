@@ -13,6 +13,7 @@ from PyQt5.QtWidgets import (QWidget, QHBoxLayout, QVBoxLayout,
 							 QTableWidget, QTableWidgetItem, QPlainTextEdit,
 							 QShortcut, QMenu, qApp)
 
+from executors import ThumbnailStore
 import app_constants
 import misc
 import gallerydb
@@ -447,7 +448,7 @@ class MovedPopup(misc.BasePopup):
 		title.setAlignment(Qt.AlignCenter)
 		title.adjustSize()
 		cover = QLabel()
-		img = QPixmap(gallery.profile)
+		img = QPixmap.fromImage(ThumbnailStore.qimage(gallery.profile))
 		cover.setPixmap(img)
 		text = QLabel("The path to this gallery has been renamed\n"+
 				"\n{}\n".format(os.path.basename(gallery.path))+u'\u2192'+"\n{}".format(os.path.basename(new_path)))
@@ -505,7 +506,7 @@ class DeletedPopup(misc.BasePopup):
 		main_layout = QVBoxLayout()
 		inner_layout = QHBoxLayout()
 		cover = QLabel()
-		img = QPixmap(gallery.profile)
+		img = QPixmap.fromImage(ThumbnailStore.qimage(gallery.profile))
 		cover.setPixmap(img)
 		title_lbl = QLabel(gallery.title)
 		title_lbl.setAlignment(Qt.AlignCenter)
@@ -667,7 +668,7 @@ class ImpExpData:
 				pages = self.get_pages(g.chapters[0].pages)
 				hashes = gallerydb.HashDB.gen_gallery_hash(g, 0, pages)
 				for p in hashes:
-					if hashes[p] != identifier[str(p)]:
+					if hashes[p].hex() != identifier[str(p)]:
 						break
 				else:
 					found = g
@@ -784,7 +785,7 @@ class ImportExport(QObject):
 				log_e("Failed to export gallery: {}".format(g.title.encode(errors='ignore')))
 				continue
 			for n in pages:
-				g_data['identifier'][n] = h_list[n]
+				g_data['identifier'][n] = h_list[n].hex()
 
 			data.add_data(str(g.id), g_data)
 			self.progress.emit(prog)
@@ -14,6 +14,7 @@
 
 import sys, logging, logging.handlers, os, argparse, platform, scandir
 import traceback
+import multiprocessing
 
 from PyQt5.QtWidgets import QApplication
 from PyQt5.QtCore import QFile, Qt
@@ -113,6 +114,7 @@ def start(test=False):
 	application.setApplicationDisplayName('Happypanda')
 	application.setApplicationVersion('v{}'.format(app_constants.vs))
 	application.setAttribute(Qt.AA_UseHighDpiPixmaps)
+	app_constants.DEVICE_PIXEL_RATIO = application.devicePixelRatio()
 
 	log_i('Starting Happypanda...'.format(app_constants.vs))
 	if args.debug:
@@ -252,6 +254,7 @@ def start(test=False):
 		return db_upgrade()
 
 if __name__ == '__main__':
+	multiprocessing.freeze_support() # thumbnail worker processes in frozen builds
 	current_exit_code = 0
 	while current_exit_code == app_constants.APP_RESTART_CODE:
 		current_exit_code = start()
@@ -1190,17 +1190,18 @@ class GalleryMenu(QMenu):
         self.view.gallery_model._gallery_to_remove.extend(galleries)
         self.view.gallery_model.removeRows(self.view.gallery_model.rowCount() - rows, rows)
         self.parent_widget.default_manga_view.add_gallery(galleries)
-        for g in galleries:
-            gallerydb.execute(gallerydb.GalleryDB.modify_gallery,
-                                True, g.id, view=g.view)
+        gallerydb.execute(gallerydb.GalleryDB.modify_galleries,
+                            True, [(g.id, {'view':g.view}) for g in galleries])
 
     def allow_metadata_fetch(self):
         exed = 0 if self.allow_metadata_exed else 1
         if self.selected:
+            changes = []
             for idx in self.selected:
                 g = idx.data(Qt.UserRole + 1)
                 g.exed = exed
-                gallerydb.execute(gallerydb.GalleryDB.modify_gallery, True, g.id, {'exed':exed})
+                changes.append((g.id, {'exed':exed}))
+            gallerydb.execute(gallerydb.GalleryDB.modify_galleries, True, changes)
         else:
             self.gallery.exed = exed
             gallerydb.execute(gallerydb.GalleryDB.modify_gallery, True, self.gallery.id, {'exed':exed})
@@ -2234,12 +2235,10 @@ class ChapterAddWidget(QWidget):
                 chap.title = utils.title_parser(os.path.split(p)[1])['title']
                 chap.path = p
                 if os.path.isdir(p):
-                    chap.pages = len(list(scandir.scandir(p)))
+                    chap.pages = utils.page_count(p)
                 elif p.endswith(utils.ARCHIVE_FILES):
                     chap.in_archive = 1
-                    arch = utils.ArchiveFile(p)
-                    chap.pages = len(arch.dir_contents(''))
-                    arch.close()
+                    chap.pages = utils.page_count(*utils.PageSource.source_args(p))
 
         self.CHAPTERS.emit(chapters)
         self.close()
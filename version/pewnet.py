@@ -973,8 +973,13 @@ class EHen(CommenHen):
 			if cookies:
 				self.check_cookie(cookies)
 				self._browser.session.cookies.update(self.COOKIES)
-			log_d("searching with color img: {}".format(filepath))
-			files = {'sfile': open(filepath,'rb')}
+			# archive pages are passed as bytes
+			if isinstance(filepath, bytes):
+				log_d("searching with color img from archive")
+				files = {'sfile': ('image', filepath)}
+			else:
+				log_d("searching with color img: {}".format(filepath))
+				files = {'sfile': open(filepath,'rb')}
 			values = {'fs_similar': '1'}
 			if app_constants.INCLUDE_EH_EXPUNGED:
 				values['fs_exp'] = '1'
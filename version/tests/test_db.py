@@ -0,0 +1,85 @@
+import threading
+
+import pytest
+
+from database import db
+from database.db import DBBase
+
+
+@pytest.fixture
+def writer(tmp_path):
+    "A WAL database with a read pool, like the one the app runs on"
+    DBBase._DB_CONN = db.init_db(str(tmp_path / 'test.db'))
+    yield DBBase
+    DBBase.close()
+    DBBase._DB_CONN = None
+
+
+def namespaces():
+    return sorted(r[0] for r in DBBase.execute(DBBase, 'SELECT namespace FROM namespaces'))
+
+
+def test_other_thread_doesnt_see_open_transaction(writer):
+    writer.begin_group()
+    writer.execute(writer, "INSERT INTO namespaces(namespace) VALUES('owner')")
+    seen = []
+    t = threading.Thread(target=lambda: seen.extend(namespaces()))
+    t.start()
+    t.join(5)
+    assert seen == []
+    assert namespaces() == ['owner']
+    writer.end_group()
+
+
+def test_other_thread_reads_back_its_writes_during_group(writer):
+    writer.begin_group()
+    writer.execute(writer, "INSERT INTO namespaces(namespace) VALUES('owner')")
+    seen = []
+
+    def other():
+        writer.execute(writer, "INSERT INTO namespaces(namespace) VALUES('other')")
+        seen.extend(namespaces())
+
+    t = threading.Thread(target=other)
+    t.start()
+    t.join(0.2)
+    # waits for the group to commit instead of writing into it
+    assert t.is_alive()
+    writer.end_group()
+    t.join(5)
+    assert not t.is_alive()
+    assert seen == ['other', 'owner']
+
+
+def test_other_thread_transaction_doesnt_roll_back_group(writer):
+    writer.begin_group()
+    writer.execute(writer, "INSERT INTO namespaces(namespace) VALUES('owner')")
+
+    def other():
+        try:
+            with writer.transaction():
+                writer.execute(writer, "INSERT INTO namespaces(namespace) VALUES('other')")
+                raise ValueError
+        except ValueError:
+            pass
+
+    t = threading.Thread(target=other)
+    t.start()
+    t.join(0.2)
+    assert t.is_alive()
+    writer.end_group()
+    t.join(5)
+    assert namespaces() == ['owner']
+
+
+def test_nested_savepoints(writer):
+    with writer.transaction():
+        writer.execute(writer, "INSERT INTO namespaces(namespace) VALUES('a')")
+        with writer.transaction():
+            writer.execute(writer, "INSERT INTO namespaces(namespace) VALUES('b')")
+            with pytest.raises(ValueError):
+                with writer.transaction():
+                    writer.execute(writer, "INSERT INTO namespaces(namespace) VALUES('c')")
+                    raise ValueError
+    assert namespaces() == ['a', 'b']
+    assert writer._STATE['savepoints'] == 0
@@ -0,0 +1,33 @@
+import sqlite3
+
+import pytest
+
+from database import db
+
+# (query, index its plan has to use)
+LOOKUPS = [
+    ('SELECT * FROM series WHERE series_path=?', 'idx_series_path'),
+    ('SELECT * FROM chapters WHERE series_id=?', 'idx_chapters_series'),
+    ('SELECT hash FROM hashes WHERE series_id=?', 'idx_hashes_series'),
+    ('SELECT hash, page FROM hashes WHERE series_id=? AND chapter_id=?', 'idx_hashes_series'),
+    ('SELECT hash FROM hashes WHERE series_id=? AND chapter_id=? AND page=?', 'idx_hashes_series'),
+    ('DELETE FROM hashes WHERE chapter_id=?', 'idx_hashes_chapter'),
+    ('SELECT tags_mappings_id FROM series_tags_map WHERE series_id=?', 'sqlite_autoindex_series_tags_map_1'),
+    ('SELECT tags_mappings_id, namespace_id, tag_id FROM tags_mappings WHERE tag_id IN (?, ?)',
+     'idx_tags_mappings_tag'),
+    ('SELECT list_id FROM series_list_map WHERE series_id=?', 'idx_series_list_map_series'),
+    ]
+
+
+@pytest.fixture(scope='module')
+def conn():
+    conn = sqlite3.connect(':memory:')
+    conn.executescript(db.STRUCTURE_SCRIPT)
+    yield conn
+    conn.close()
+
+
+@pytest.mark.parametrize('query, index', LOOKUPS)
+def test_lookup_uses_index(conn, query, index):
+    plan = [r[-1] for r in conn.execute('EXPLAIN QUERY PLAN ' + query, [None]*query.count('?'))]
+    assert any(d.startswith('SEARCH') and ' INDEX {}'.format(index) in d for d in plan), plan
@@ -18,16 +18,23 @@ import subprocess
 import sys
 import logging
 import zipfile
+import zlib
+import sqlite3
 import hashlib
+import mmap
+import struct
 import shutil
 import uuid
 import re
 import scandir
 import rarfile
 import json
+import io
 import send2trash
 import functools
 import time
+import threading
+import collections
 
 from PyQt5.QtGui import QImage, qRgba
 from PIL import Image,ImageChops
@@ -69,16 +76,17 @@ class GMetafile:
 		self.files = []
 		if path is None:
 			return
-		if archive:
-			zip = ArchiveFile(archive)
-			c = zip.dir_contents(path)
-			for x in c:
-				if x.endswith(app_constants.GALLERY_METAFILE_KEYWORDS):
-					self.files.append(open(zip.extract(x), encoding='utf-8'))
-		else:
-			for p in scandir.scandir(path):
-				if p.name in app_constants.GALLERY_METAFILE_KEYWORDS:
-					self.files.append(open(p.path, encoding='utf-8'))
+		# the manifest tells if there's anything to read without opening the archive
+		if not archive or ArchiveManifest.load(archive).has_metafile(path):
+			source = PageSource(path, archive)
+			for x in source.metafiles():
+				if archive:
+					fp = io.StringIO(source.read(x).decode('utf-8'))
+					fp.name = x
+				else:
+					fp = open(x, encoding='utf-8')
+				self.files.append(fp)
+			source.close()
 		if self.files:
 			self.detect()
 		else:
@@ -190,7 +198,20 @@ def backup_database(db_path=db_constants.DB_PATH):
 			dst_path = os.path.join(backup_dir, db_name)
 			if os.path.exists(dst_path):
 				raise ValueError
-			shutil.copyfile(db_path, dst_path)
+			src = sqlite3.connect(db_path)
+			try:
+				if hasattr(src, 'backup'):
+					# the backup api also picks up changes still in the WAL file
+					dst = sqlite3.connect(dst_path)
+					try:
+						src.backup(dst)
+					finally:
+						dst.close()
+				else: # python < 3.7, move the WAL into the DB file before copying it
+					src.execute('PRAGMA wal_checkpoint(FULL)')
+					shutil.copyfile(db_path, dst_path)
+			finally:
+				src.close()
 			break
 		except ValueError:
 			current_try += 1
@@ -277,6 +298,7 @@ def move_files(path, dest=''):
 		return path
 	if not os.path.exists(new_path):
 		app_constants.TEMP_PATH_IGNORE.append(os.path.normcase(new_path))
+		ArchivePool.discard(path)
 		new_path = shutil.move(path, new_path)
 	else:
 		return path
@@ -329,44 +351,352 @@ def b_search(data, key):
 			return data[mid]
 	return None
 
+HASH_CHUNK_SIZE = 1024 * 1024
+
 def generate_img_hash(src):
 	"""
-	Generates sha1 hash based on the given bytes.
-	Returns hex-digits
+	Generates sha1 hash based on the given file path, bytes or file-like object.
+	File paths are read through mmap, file-like objects in large blocks.
+	Returns the raw 20-byte digest, use .hex() for hex-digits
 	"""
-	chunk = 8129
 	sha1 = hashlib.sha1()
-	buffer = src.read(chunk)
 	log_d("Generating hash")
-	while len(buffer) > 0:
-		sha1.update(buffer)
-		buffer = src.read(chunk)
-	return sha1.hexdigest()
+	if isinstance(src, (bytes, bytearray, memoryview)):
+		sha1.update(src)
+	elif isinstance(src, str):
+		with open(src, 'rb') as f:
+			try:
+				with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+					sha1.update(m)
+			except ValueError: # empty files can't be mapped
+				pass
+	else:
+		buffer = src.read(HASH_CHUNK_SIZE)
+		while len(buffer) > 0:
+			sha1.update(buffer)
+			buffer = src.read(HASH_CHUNK_SIZE)
+	return sha1.digest()
+
+class ArchiveIndex:
+	"""
+	Archive members indexed by their parent directory, so lookups don't scan the namelist.
+	Built from a list of (name, size, is_dir) members.
+	"""
+	def __init__(self, archive_type, members):
+		self.type = archive_type
+		self.members = members
+		self.namelist = [x[0] for x in members]
+		if archive_type == ArchiveFile.zip:
+			self.dirs = [x for x in self.namelist if x.endswith('/')]
+		else:
+			self.dirs = [x[0] for x in members if x[2]]
+		self.names = set(self.namelist)
+		self.dir_set = set(self.dirs)
+		self.children = {'':[]}
+		for name in self.namelist:
+			if archive_type == ArchiveFile.zip:
+				parent = name.rstrip('/').rpartition('/')[0]
+				parent = parent + '/' if parent else ''
+				if name.endswith('/'):
+					# a zip directory lists itself among its contents
+					self.children.setdefault(name, []).append(name)
+			else:
+				parent = name.rpartition('/')[0]
+			self.children.setdefault(parent, []).append(name)
+
+	def is_dir(self, name):
+		if not name:
+			return False
+		if not name in self.names:
+			log_e('File {} not found in archive'.format(name))
+			raise app_constants.FileNotFoundInArchive
+		if self.type == ArchiveFile.zip:
+			return name.endswith('/')
+		return name in self.dir_set
+
+	def dir_list(self, only_top_level=False):
+		if only_top_level:
+			return [x for x in self.children[''] if x in self.dir_set]
+		return list(self.dirs)
+
+	def dir_contents(self, dir_name):
+		if dir_name and not dir_name in self.names:
+			log_e('Directory {} not found in archive'.format(dir_name))
+			raise app_constants.FileNotFoundInArchive
+		return list(self.children.get(dir_name, []))
+
+	def dir_members(self, dir_name):
+		"Returns all members below the given directory"
+		membs = []
+		stack = [dir_name]
+		while stack:
+			current = stack.pop()
+			for name in self.children.get(current, []):
+				if name == current:
+					continue
+				membs.append(name)
+				if name in self.dir_set:
+					stack.append(name)
+		return membs
+
+class _StoredMember(io.RawIOBase):
+	"A read-only file-like object over the bytes of a stored zip member"
+	def __init__(self, view):
+		super().__init__()
+		self._view = view
+		self._pos = 0
+
+	def readable(self):
+		return True
+
+	def seekable(self):
+		return True
+
+	def readinto(self, b):
+		n = max(0, min(len(b), len(self._view) - self._pos))
+		b[:n] = self._view[self._pos:self._pos + n]
+		self._pos += n
+		return n
+
+	def readall(self):
+		data = bytes(self._view[self._pos:])
+		self._pos = len(self._view)
+		return data
+
+	def seek(self, offset, whence=io.SEEK_SET):
+		if whence == io.SEEK_CUR:
+			offset += self._pos
+		elif whence == io.SEEK_END:
+			offset += len(self._view)
+		if offset < 0:
+			raise ValueError('negative seek position {}'.format(offset))
+		self._pos = offset
+		return self._pos
+
+	def tell(self):
+		return self._pos
+
+	def close(self):
+		if not self.closed:
+			self._view.release()
+		super().close()
+
+class _PooledArchive:
+	"""
+	An opened archive with its member index, shared by ArchiveFile instances.
+	Stored (uncompressed) zip members are served from an mmap of the archive, see stored_view.
+	"""
+	_LOCAL_HEADER = struct.Struct('<4s22xHH') # signature, name and extra field lengths
+	_NOT_STORED = (-1, 0, 0)
+
+	def __init__(self, path, key):
+		self.path = path
+		self.key = key # (normalized path, size, mtime)
+		self.users = 0
+		self.stale = False
+		self._map = None
+		self._map_lock = threading.Lock()
+		self._stored = {} # member name -> (data offset, size, crc), offset is -1 if not stored
+		self.crc_checked = set() # stored members which passed the crc check
+		if path.endswith(ARCHIVE_FILES[:2]):
+			self.archive = zipfile.ZipFile(os.path.normcase(path))
+			self.type = ArchiveFile.zip
+		else:
+			self.archive = rarfile.RarFile(os.path.normcase(path))
+			self.type = ArchiveFile.rar
+		try:
+			if self.type == ArchiveFile.zip:
+				members = [(x.filename, x.file_size, x.filename.endswith('/')) for x in self.archive.infolist()]
+			else:
+				members = [(x.filename, x.file_size, x.isdir()) for x in self.archive.infolist()]
+			self.index = ArchiveIndex(self.type, members)
+		except:
+			self.archive.close()
+			raise
+
+	def _mmap(self):
+		with self._map_lock:
+			if self._map is None:
+				with open(self.path, 'rb') as f:
+					try:
+						self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+					except ValueError: # empty files can't be mapped
+						self._map = False
+			return self._map
+
+	def _stored_entry(self, name):
+		"Returns (data offset, size, crc) of a stored member, offset is -1 if it can't be mapped"
+		entry = self._stored.get(name)
+		if entry is None:
+			entry = self._NOT_STORED
+			try:
+				info = self.archive.getinfo(name)
+			except KeyError:
+				info = None
+			# encrypted members (flag bit 0) need the zipfile decrypter
+			if info and not info.is_dir() and info.compress_type == zipfile.ZIP_STORED and not info.flag_bits & 0x1:
+				m = self._mmap()
+				h_end = info.header_offset + self._LOCAL_HEADER.size
+				if m and h_end <= len(m):
+					sig, n_len, e_len = self._LOCAL_HEADER.unpack(m[info.header_offset:h_end])
+					start = h_end + n_len + e_len
+					if sig == b'PK\x03\x04' and start + info.file_size <= len(m):
+						entry = (start, info.file_size, info.CRC)
+			self._stored[name] = entry
+		return entry
+
+	def stored_view(self, name, check_crc=False):
+		"""
+		Returns a memoryview of the member's bytes in the mmapped archive if the member is stored
+		(not compressed), else None. Nothing is copied or decompressed.
+		With check_crc a member is checked the first time it's viewed, raises BadZipFile on mismatch.
+		"""
+		if self.type != ArchiveFile.zip or self.stale:
+			return None
+		start, size, crc = self._stored_entry(name)
+		if start < 0:
+			return None
+		try:
+			view = memoryview(self._map)[start:start + size]
+		except ValueError: # closed by the pool meanwhile
+			return None
+		if check_crc and name not in self.crc_checked:
+			if zlib.crc32(view) != crc:
+				view.release()
+				raise zipfile.BadZipFile('Bad CRC-32 for file {!r}'.format(name))
+			self.crc_checked.add(name)
+		return view
+
+	def close(self):
+		try:
+			self.archive.close()
+		except:
+			log.exception('Failed to close archive')
+		if self._map:
+			try:
+				self._map.close()
+			except BufferError:
+				pass # views are still held, the map is closed when the last one is released
+
+class ArchivePool:
+	"""
+	Keeps archives open so ArchiveFile instances on the same file share one handle.
+	Archives are keyed by normalized path and reopened when their size or mtime changes.
+	The least recently used idle archives are closed when more than 'archive pool size' are open.
+	acquire -> returns the opened archive for the given path, opening it if needed
+	release <- hands an archive back
+	discard <- forgets archives at or below the given path, closing them once idle
+	clear <- forgets all archives
+	"""
+	_lock = threading.Lock()
+	_archives = collections.OrderedDict() # normalized path -> _PooledArchive
+
+	@staticmethod
+	def _normalize(path):
+		return os.path.normcase(os.path.abspath(path))
+
+	@classmethod
+	def acquire(cls, path):
+		st = os.stat(path)
+		n_path = cls._normalize(path)
+		key = (n_path, st.st_size, st.st_mtime)
+		with cls._lock:
+			pooled = cls._archives.get(n_path)
+			if pooled and pooled.key == key:
+				cls._archives.move_to_end(n_path)
+				pooled.users += 1
+				return pooled
+			if pooled:
+				cls._forget(n_path)
+		# open outside the lock, other archives shouldn't wait on slow disks
+		pooled = _PooledArchive(path, key)
+		pooled.users += 1
+		with cls._lock:
+			if n_path in cls._archives:
+				cls._forget(n_path)
+			cls._archives[n_path] = pooled
+			cls._evict()
+		return pooled
+
+	@classmethod
+	def release(cls, pooled):
+		with cls._lock:
+			pooled.users -= 1
+			if pooled.stale:
+				if not pooled.users:
+					pooled.close()
+			else:
+				cls._evict()
+
+	@classmethod
+	def discard(cls, path):
+		n_path = cls._normalize(path)
+		with cls._lock:
+			for p in list(cls._archives):
+				if p == n_path or p.startswith(os.path.join(n_path, '')):
+					cls._forget(p)
+
+	@classmethod
+	def clear(cls):
+		with cls._lock:
+			for p in list(cls._archives):
+				cls._forget(p)
+
+	@classmethod
+	def _forget(cls, n_path):
+		pooled = cls._archives.pop(n_path)
+		pooled.stale = True
+		if not pooled.users:
+			pooled.close()
+
+	@classmethod
+	def _evict(cls):
+		"Closes least recently used idle archives until the pool is within its size"
+		excess = len(cls._archives) - app_constants.ARCHIVE_POOL_SIZE
+		for p in list(cls._archives):
+			if excess <= 0:
+				break
+			if not cls._archives[p].users:
+				cls._forget(p)
+				excess -= 1
 
 class ArchiveFile():
 	"""
 	Work with archive files, raises exception if instance fails.
 	namelist -> returns a list with all files in archive
+	members -> returns a list with (name, size, is_dir) of all files in archive
 	extract <- Extracts one specific file to given path
 	open -> open the given file in archive, returns bytes
+	view -> returns a memoryview of a stored zip member without copying it
 	close -> close archive
+
+	validation decides how archives are checked for corruption, defaults to the
+	'archive validation' setting:
+	none -> never checked, but a member that can't be decoded still raises CreateArchiveFail
+	lazy -> members are checked when read, a bad member raises CreateArchiveFail
+	full -> every member is checked when opened, results are cached by path, size and mtime
 	"""
 	zip, rar = range(2)
-	def __init__(self, filepath):
+	NO_VALIDATION, LAZY_VALIDATION, FULL_VALIDATION = 'none', 'lazy', 'full'
+
+	# (path, size, mtime) -> True if archive passed full validation
+	_validated = {}
+	_validated_lock = threading.Lock()
+
+	def __init__(self, filepath, validation=None):
 		self.type = 0
+		self.filepath = filepath
+		self.validation = validation or app_constants.ARCHIVE_VALIDATION
+		self._pooled = None
 		try:
 			if filepath.endswith(ARCHIVE_FILES):
-				if filepath.endswith(ARCHIVE_FILES[:2]):
-					self.archive = zipfile.ZipFile(os.path.normcase(filepath))
-					b_f = self.archive.testzip()
-					self.type = self.zip
-				elif filepath.endswith(ARCHIVE_FILES[2:]):
-					self.archive = rarfile.RarFile(os.path.normcase(filepath))
-					b_f = self.archive.testrar()
-					self.type = self.rar
+				self._pooled = ArchivePool.acquire(filepath)
+				self.archive = self._pooled.archive
+				self.type = self._pooled.type
+				self._index = self._pooled.index
 
 				# test for corruption
-				if b_f:
+				if self.validation == self.FULL_VALIDATION and not self._validate():
 					log_w('Bad file found in archive {}'.format(filepath.encode(errors='ignore')))
 					raise app_constants.CreateArchiveFail
 			else:
@@ -374,70 +704,60 @@ class ArchiveFile():
 				raise app_constants.CreateArchiveFail
 		except:
 			log.exception('Create archive: FAIL')
+			self.close()
 			raise app_constants.CreateArchiveFail
 
+	def __del__(self):
+		try:
+			self.close()
+		except Exception:
+			pass
+
+	def _validate(self):
+		"Tests all members once per path, size and mtime. Returns True if archive is good"
+		key = self._pooled.key
+		with self._validated_lock:
+			if key in self._validated:
+				return self._validated[key]
+		if self.type == self.zip:
+			b_f = self.archive.testzip()
+		else:
+			b_f = self.archive.testrar()
+		with self._validated_lock:
+			self._validated[key] = not b_f
+		return not b_f
+
+	def _mark_bad(self):
+		with self._validated_lock:
+			self._validated[self._pooled.key] = False
+		ArchivePool.discard(self.filepath)
+
 	def namelist(self):
-		filelist = self.archive.namelist()
-		return filelist
+		return list(self._index.namelist)
+
+	def members(self):
+		"Returns a list of (name, size, is_dir) for all files in archive"
+		return list(self._index.members)
 
 	def is_dir(self, name):
 		"""
 		Checks if the provided name in the archive is a directory or not
 		"""
-		if not name:
-			return False
-		if not name in self.namelist():
-			log_e('File {} not found in archive'.format(name))
-			raise app_constants.FileNotFoundInArchive
-		if self.type == self.zip:
-			if name.endswith('/'):
-				return True
-		elif self.type == self.rar:
-			info = self.archive.getinfo(name)
-			return info.isdir()
-		return False
+		return self._index.is_dir(name)
 
 	def dir_list(self, only_top_level=False):
 		"""
 		Returns a list of all directories found recursively. For directories not in toplevel
 		a path in the archive to the diretory will be returned.
 		"""
-		
-		if only_top_level:
-			if self.type == self.zip:
-				return [x for x in self.namelist() if x.endswith('/') and x.count('/') == 1]
-			elif self.type == self.rar:
-				potential_dirs = [x for x in self.namelist() if x.count('/') == 0]
-				return [x.filename for x in [self.archive.getinfo(y) for y in potential_dirs] if x.isdir()]
-		else:
-			if self.type == self.zip:
-				return [x for x in self.namelist() if x.endswith('/') and x.count('/') >= 1]
-			elif self.type == self.rar:
-				return [x.filename for x in self.archive.infolist() if x.isdir()]
+		return self._index.dir_list(only_top_level)
 
 	def dir_contents(self, dir_name):
 		"""
 		Returns a list of contents in the directory
 		An empty string will return the contents of the top folder
 		"""
-		if dir_name and not dir_name in self.namelist():
-			log_e('Directory {} not found in archive'.format(dir_name))
-			raise app_constants.FileNotFoundInArchive
-		if not dir_name:
-			if self.type == self.zip:
-				con = [x for x in self.namelist() if x.count('/') == 0 or \
-					(x.count('/') == 1 and x.endswith('/'))]
-			elif self.type == self.rar:
-				con = [x for x in self.namelist() if x.count('/') == 0]
-			return con
-		if self.type == self.zip:
-			dir_con_start = [x for x in self.namelist() if x.startswith(dir_name)]
-			return [x for x in dir_con_start if x.count('/') == dir_name.count('/') or \
-				(x.count('/') == 1 + dir_name.count('/') and x.endswith('/'))]
-		elif self.type == self.rar:
-			return [x for x in self.namelist() if x.startswith(dir_name) and \
-				x.count('/') == 1 + dir_name.count('/')]
-		return []
+		return self._index.dir_contents(dir_name)
 
 	def extract(self, file_to_ext, path=None):
 		"""
@@ -453,10 +773,7 @@ class ArchiveFile():
 			return self.extract_all(path)
 		else:
 			if self.type == self.zip:
-				membs = []
-				for name in self.namelist():
-					if name.startswith(file_to_ext) and name != file_to_ext:
-						membs.append(name)
+				membs = self._index.dir_members(file_to_ext) if file_to_ext in self._index.dir_set else []
 				temp_p = self.archive.extract(file_to_ext, path)
 				for m in membs:
 					self.archive.extract(m, path)
@@ -478,17 +795,230 @@ class ArchiveFile():
 		self.archive.extractall(path)
 		return path
 
+	def _bad_member(self, name):
+		log_w('Bad file {} found in archive {}'.format(name.encode(errors='ignore'),
+										   self.filepath.encode(errors='ignore')))
+		self._mark_bad()
+		raise app_constants.CreateArchiveFail
+
+	def view(self, file_to_open):
+		"""
+		Returns a memoryview of a stored (uncompressed) zip member, read straight from
+		an mmap of the archive. Returns None for compressed members and rar archives.
+		With lazy validation the member's crc is checked the first time it's viewed.
+		"""
+		try:
+			return self._pooled.stored_view(file_to_open, self.validation == self.LAZY_VALIDATION)
+		except zipfile.BadZipFile:
+			self._bad_member(file_to_open)
+
 	def open(self, file_to_open, fp=False):
 		"""
 		Returns bytes. If fp set to true, returns file-like object.
+		Stored zip members are read from the mmapped archive, see view.
+		File-like objects are checked for corruption by the archive module while read.
 		"""
+		view = self.view(file_to_open)
+		if view is not None:
+			if fp:
+				return _StoredMember(view)
+			with view:
+				return bytes(view)
 		if fp:
 			return self.archive.open(file_to_open)
-		else:
+		try:
 			return self.archive.open(file_to_open).read()
+		except (zipfile.BadZipFile, rarfile.Error, zlib.error):
+			self._bad_member(file_to_open)
+
+	def close(self):
+		"Hands the archive back to the pool"
+		pooled, self._pooled = getattr(self, '_pooled', None), None
+		if pooled:
+			ArchivePool.release(pooled)
+
+def page_names(names):
+	"Returns the sorted names of the pages among the given file or member names"
+	return sorted([x for x in names if x.lower().endswith(IMG_FILES)])
+
+def page_count(path, archive=None):
+	"""
+	Returns the number of pages PageSource(path, archive) would list.
+	Archive members are taken from the archive's manifest.
+	"""
+	if archive:
+		manifest = ArchiveManifest.load(archive)
+		names = manifest.index.namelist if path == None else manifest.dir_contents(path)
+		return len(page_names(names))
+	return len(page_names([x.name for x in scandir.scandir(path) if not x.is_dir()]))
+
+class PageSource:
+	"""
+	The pages of a chapter in a folder, zip or rar, read without extracting anything to disk.
+	path is a folder, or a directory in archive when archive is set.
+	With an archive and path set to None all images in archive are pages.
+	pages -> returns the ordered names of all pages
+	src -> returns a file path for folder pages, a memoryview for stored zip members, else a file-like object
+	open -> returns a file-like object of the given page
+	read -> returns bytes of the given page
+	metafiles -> returns names of metafiles next to the pages
+	close -> close source
+	"""
+	def __init__(self, path, archive=None):
+		self.path = path
+		self.archive = None
+		if archive:
+			self.archive = ArchiveFile(archive)
+			if path == None:
+				self._names = self.archive.namelist()
+			else:
+				self._names = self.archive.dir_contents(path)
+		else:
+			self._names = [x.path for x in scandir.scandir(path) if not x.is_dir()]
+		self._pages = page_names(self._names)
+
+	@staticmethod
+	def source_args(gallery_or_path, chap_number=0):
+		"Returns the (path, archive) arguments for the source of a gallery's chapter, or of a path to a folder or archive"
+		if isinstance(gallery_or_path, str):
+			if gallery_or_path.endswith(ARCHIVE_FILES):
+				return None, gallery_or_path
+			return gallery_or_path, None
+		chap = gallery_or_path.chapters[chap_number]
+		if gallery_or_path.is_archive:
+			return chap.path, gallery_or_path.path
+		if chap.path.endswith(ARCHIVE_FILES):
+			return None, chap.path
+		return chap.path, None
+
+	@classmethod
+	def for_gallery(cls, gallery_or_path, chap_number=0):
+		"Returns the source of a gallery's chapter, or of a path to a folder or archive"
+		return cls(*cls.source_args(gallery_or_path, chap_number))
+
+	@property
+	def in_archive(self):
+		return self.archive != None
+
+	def pages(self):
+		return list(self._pages)
+
+	def src(self, name):
+		if self.archive:
+			# stored zip members are hashed straight from the mmapped archive
+			view = self.archive.view(name)
+			if view is not None:
+				return view
+			return self.archive.open(name, True)
+		return name
+
+	def open(self, name):
+		if self.archive:
+			view = self.archive.view(name)
+			if view is not None:
+				return _StoredMember(view)
+			# compressed members are read whole, so corruption is caught here and not mid-decode
+			return io.BytesIO(self.archive.open(name))
+		return open(name, 'rb')
+
+	def read(self, name):
+		if self.archive:
+			return self.archive.open(name)
+		with open(name, 'rb') as f:
+			return f.read()
+
+	def metafiles(self):
+		if self.archive:
+			return [x for x in self._names if x.endswith(app_constants.GALLERY_METAFILE_KEYWORDS)]
+		return [x for x in self._names if os.path.basename(x) in app_constants.GALLERY_METAFILE_KEYWORDS]
 
 	def close(self):
-		self.archive.close()
+		if self.archive:
+			self.archive.close()
+
+class ArchiveManifest:
+	"""
+	The member list and gallery layout of an archive. Stored in DB keyed by path, size and mtime,
+	so unchanged archives don't have to be opened again.
+	load -> returns the manifest of an archive, only reading the archive if it's unknown or changed
+	set_galleries <- stores the galleries found by check_archive
+	dir_contents -> same as ArchiveFile.dir_contents
+	has_metafile -> returns True if the given directory contains a metafile
+	"""
+	_cache = collections.OrderedDict() # normalized path -> ArchiveManifest
+	_cache_lock = threading.Lock()
+	_cache_size = 32
+
+	def __init__(self, path, key, members, galleries=None):
+		self.path = path
+		self.key = key # (normalized path, size, mtime)
+		self.galleries = galleries
+		a_type = ArchiveFile.zip if path.endswith(ARCHIVE_FILES[:2]) else ArchiveFile.rar
+		self.index = ArchiveIndex(a_type, members)
+
+	@staticmethod
+	def _db():
+		# gallerydb imports this module
+		import gallerydb
+		return gallerydb
+
+	@classmethod
+	def load(cls, path):
+		try:
+			st = os.stat(path)
+		except OSError:
+			log.exception('Create archive manifest: FAIL')
+			raise app_constants.CreateArchiveFail
+		n_path = ArchivePool._normalize(path)
+		key = (n_path, st.st_size, st.st_mtime)
+		with cls._cache_lock:
+			manifest = cls._cache.get(n_path)
+			if manifest and manifest.key == key:
+				cls._cache.move_to_end(n_path)
+				return manifest
+
+		manifest = cls._from_db(path, key)
+		if not manifest:
+			archive = ArchiveFile(path)
+			try:
+				manifest = cls(path, key, archive.members())
+			finally:
+				archive.close()
+			manifest._save()
+
+		with cls._cache_lock:
+			cls._cache[n_path] = manifest
+			while len(cls._cache) > cls._cache_size:
+				cls._cache.popitem(False)
+		return manifest
+
+	@classmethod
+	def _from_db(cls, path, key):
+		gdb = cls._db()
+		try:
+			row = gdb.execute(gdb.ManifestDB.get_manifest, False, key[0])
+		except db_constants.NoDatabaseConnection:
+			return None
+		if not row or (row['size'], row['mtime']) != key[1:]:
+			return None
+		galleries = json.loads(row['galleries']) if row['galleries'] != None else None
+		return cls(path, key, json.loads(row['members']), galleries)
+
+	def _save(self):
+		gdb = self._db()
+		galleries = json.dumps(self.galleries) if self.galleries != None else None
+		gdb.execute(gdb.ManifestDB.set_manifest, True, self.key[0], self.key[1], self.key[2],
+				json.dumps(self.index.members), galleries)
+
+	def set_galleries(self, galleries):
+		self.galleries = list(galleries)
+		self._save()
+
+	def dir_contents(self, dir_name):
+		return self.index.dir_contents(dir_name)
+
+	def has_metafile(self, dir_name):
+		return any(x.endswith(app_constants.GALLERY_METAFILE_KEYWORDS) for x in self.dir_contents(dir_name))
 
 def check_archive(archive_path):
 	"""
@@ -497,15 +1027,15 @@ def check_archive(archive_path):
 	if there is no directories
 	"""
 	try:
-		zip = ArchiveFile(archive_path)
+		manifest = ArchiveManifest.load(archive_path)
 	except app_constants.CreateArchiveFail:
 		return []
-	if not zip:
-		return []
+	if manifest.galleries != None:
+		return list(manifest.galleries)
 	galleries = []
-	zip_dirs = zip.dir_list()
+	zip_dirs = manifest.index.dir_list()
 	def gallery_eval(d):
-		con = zip.dir_contents(d)
+		con = manifest.dir_contents(d)
 		if con:
 			gallery_probability = len(con)
 			for n in con:
@@ -522,12 +1052,11 @@ def check_archive(archive_path):
 			r = gallery_eval(d)
 			if r:
 				galleries.append(r)
-		zip.close()
 	else: # all pages are in top folder
 		if isinstance(gallery_eval(''), str):
 			galleries.append('')
-		zip.close()
 
+	manifest.set_galleries(galleries)
 	return galleries
 
 def recursive_gallery_check(path):
@@ -706,42 +1235,28 @@ def open_chapter(chapterpath, archive=None):
 def get_gallery_img(gallery_or_path, chap_number=0):
 	"""
 	Returns a path to image in gallery chapter
+	Images in archives are extracted, use PageSource to read them without extracting.
 	"""
-	archive = None
-	if isinstance(gallery_or_path, str):
-		path = gallery_or_path
-	else:
-		path = gallery_or_path.chapters[chap_number].path
-		if gallery_or_path.is_archive:
-			archive = gallery_or_path.path
-
-	# TODO: add chapter support
-	try:
-		name = os.path.split(path)[1]
-	except IndexError:
-		name = os.path.split(path)[0]
-	is_archive = True if archive or name.endswith(ARCHIVE_FILES) else False
-	real_path = archive if archive else path
 	img_path = None
-	if is_archive:
+	try:
+		source = PageSource.for_gallery(gallery_or_path, chap_number)
+	except app_constants.CreateArchiveFail:
+		return app_constants.NO_IMAGE_PATH
+	except OSError:
+		source = None
+	if source:
 		try:
-			log_i('Getting image from archive')
-			zip = ArchiveFile(real_path)
-			temp_path = os.path.join(app_constants.temp_dir, str(uuid.uuid4()))
-			os.mkdir(temp_path)
-			if not archive:
-				f_img_name = sorted([img for img in zip.namelist() if img.lower().endswith(IMG_FILES)])[0]
-			else:
-				f_img_name = sorted([img for img in zip.dir_contents(path) if img.lower().endswith(IMG_FILES)])[0]
-			img_path = zip.extract(f_img_name, temp_path)
-			zip.close()
-		except app_constants.CreateArchiveFail:
-			img_path = app_constants.NO_IMAGE_PATH
-	elif os.path.isdir(real_path):
-		log_i('Getting image from folder')
-		first_img = sorted([img.name for img in scandir.scandir(real_path) if img.name.lower().endswith(tuple(IMG_FILES))])
-		if first_img:
-			img_path = os.path.join(real_path, first_img[0])
+			first_img = source.pages()[:1]
+			if first_img and source.in_archive:
+				log_i('Getting image from archive')
+				temp_path = os.path.join(app_constants.temp_dir, str(uuid.uuid4()))
+				os.mkdir(temp_path)
+				img_path = source.archive.extract(first_img[0], temp_path)
+			elif first_img:
+				log_i('Getting image from folder')
+				img_path = first_img[0]
+		finally:
+			source.close()
 
 	if img_path:
 		return os.path.abspath(img_path)
@@ -966,6 +1481,7 @@ def open_torrent(path):
 def delete_path(path):
 	"Deletes the provided recursively"
 	s = True
+	ArchivePool.discard(path)
 	if os.path.exists(path):
 		error = ''
 		if app_constants.SEND_FILES_TO_TRASH:
@@ -1217,14 +1733,14 @@ def make_chapters(gallery_object):
 				chap.title = title_parser(ch)['title']
 				chap.path = os.path.join(path, ch)
 				metafile.update(GMetafile(chap.path))
-				chap.pages = len([x for x in scandir.scandir(chap.path) if x.name.endswith(IMG_FILES)])
+				chap.pages = page_count(*PageSource.source_args(chap.path))
 
 		else: #else assume that all images are in gallery folder
 			chap = chap_container.create_chapter()
 			chap.title = title_parser(os.path.split(path)[1])['title']
 			chap.path = path
 			metafile.update(GMetafile(path))
-			chap.pages = len([x for x in scandir.scandir(path) if x.name.endswith(IMG_FILES)])
+			chap.pages = page_count(path)
 
 	except NotADirectoryError:
 		if path.endswith(ARCHIVE_FILES):
@@ -1236,9 +1752,7 @@ def make_chapters(gallery_object):
 				chap.path = g
 				chap.in_archive = 1
 				metafile.update(GMetafile(g, path))
-				arch = ArchiveFile(path)
-				chap.pages = len(arch.dir_contents(g))
-				arch.close()
+				chap.pages = page_count(g, path)
 
 	metafile.apply_gallery(gallery_object)
 